@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Measure how long `access-client` takes from process start to the first
+data message arriving at the relay, and how long its imports take.
+
+A minimal relay is started in this process, it answers every start message
+with `start_ok` and records when the first `tcp_data` message arrives. The
+data is already waiting on the client's stdin, so the measured time is the
+startup overhead that every proxied SSH connection pays.
+
+Usage: python benchmarks/access_client_startup.py [--runs N]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from websockets.asyncio.server import serve
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--runs", type=int, default=20, help="Number of measured runs")
+
+
+async def measure_first_byte(port, first_data_received):
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"SSH-2.0-benchmark\r\n")
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "http_network_relay.access_client",
+        "--secret",
+        "benchmark",
+        "--relay-url",
+        f"ws://127.0.0.1:{port}/ws_for_access_clients",
+        "agent",
+        "127.0.0.1",
+        "22",
+        "tcp",
+        stdin=read_fd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    os.close(read_fd)
+    try:
+        received_at = await asyncio.wait_for(first_data_received.get(), timeout=10)
+    finally:
+        os.close(write_fd)
+        process.kill()
+        await process.wait()
+    return received_at - start
+
+
+def measure_import_time():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import http_network_relay.access_client"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    match = re.search(
+        r"\|\s*(\d+) \| http_network_relay\.access_client$", result.stderr, re.M
+    )
+    return int(match.group(1)) / 1e6
+
+
+async def async_main():
+    args = parser.parse_args()
+    first_data_received = asyncio.Queue()
+
+    async def relay(websocket):
+        await websocket.recv()
+        await websocket.send(json.dumps({"inner": {"kind": "start_ok"}}))
+        async for message in websocket:
+            if json.loads(message)["inner"]["kind"] == "tcp_data":
+                await first_data_received.put(time.perf_counter())
+                break
+
+    async with serve(relay, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        # warm up the file system cache
+        await measure_first_byte(port, first_data_received)
+        first_byte_times = [
+            await measure_first_byte(port, first_data_received)
+            for _ in range(args.runs)
+        ]
+    import_times = [measure_import_time() for _ in range(args.runs)]
+
+    def summary(times):
+        return (
+            f"median {statistics.median(times) * 1000:.1f} ms, "
+            f"min {min(times) * 1000:.1f} ms, max {max(times) * 1000:.1f} ms"
+        )
+
+    print(f"python startup to first byte: {summary(first_byte_times)}")
+    print(f"import http_network_relay.access_client: {summary(import_times)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(async_main())
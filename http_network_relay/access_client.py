@@ -2,20 +2,21 @@ import argparse
 import asyncio
 
 import base64
+import json
 import os
+import stat
 import sys
 
+# `access-client` is started for every proxied connection, so it does not
+# import pydantic and uses the hand-written encoders from `wire_format`
 import websockets
 from websockets.asyncio.client import connect
 
-from .pydantic_models import (
-    AccessClientToRelayMessage,
-    AtRStartMessage,
-    AtRTCPDataMessage,
-    RelayToAccessClientMessage,
-    RtAErrorMessage,
-    RtAStartOKMessage,
-    RtATCPDataMessage,
+from .wire_format import (
+    decode_message,
+    encode_access_client_fanout_message,
+    encode_access_client_start_message,
+    encode_access_client_tcp_data_message,
 )
 
 parser = argparse.ArgumentParser(
@@ -42,25 +43,190 @@ parser.add_argument(
     default=os.getenv("HTTP_NETWORK_RELAY_SECRET", None),
 )
 
+fanout_parser = argparse.ArgumentParser(
+    prog="access-client-fanout",
+    description="Connect to the same target on every `edge-agent` whose name "
+    "matches the selector, through one connection to the relay.\n"
+    "The payload is sent to every target, the answers are printed with the "
+    "agent's name in front of every line.",
+)
+fanout_parser.add_argument(
+    "selector", help="Pattern of the agent names, e.g. 'sensor-*' (fnmatch)"
+)
+fanout_parser.add_argument("target_ip", help="The target IP")
+fanout_parser.add_argument("target_port", type=int, help="The target port")
+fanout_parser.add_argument("protocol", help="The protocol to use (e.g. 'udp' or 'tcp')")
+fanout_parser.add_argument(
+    "--payload",
+    help="Data to send to every target, read from stdin if not given and "
+    "stdin is not a terminal",
+)
+fanout_parser.add_argument(
+    "--parallelism",
+    help="How many targets to connect to at the same time",
+    type=int,
+    default=32,
+)
+fanout_parser.add_argument(
+    "--timeout",
+    help="Seconds after which a target that did not close the connection fails",
+    type=float,
+    default=10,
+)
+fanout_parser.add_argument(
+    "--json",
+    help="Print the relay's messages as JSON lines instead",
+    action="store_true",
+)
+fanout_parser.add_argument(
+    "--relay-url",
+    help="The relay URL",
+    default=os.getenv(
+        "HTTP_NETWORK_RELAY_URL", "ws://127.0.0.1:8000/ws_for_access_clients"
+    ),
+)
+fanout_parser.add_argument(
+    "--secret",
+    help="The secret used to authenticate with the relay",
+    default=os.getenv("HTTP_NETWORK_RELAY_SECRET", None),
+)
+
 debug = False
 if os.getenv("DEBUG") == "1":
     debug = True
 
+STDIN_READ_SIZE = 64 * 1024
+# chunks received from the relay that may wait for stdout, when full the
+# websocket is no longer read, which pushes back to the relay through TCP
+STDOUT_QUEUE_SIZE = 64
+STDOUT_BUFFER_SIZE = 256 * 1024
+# how often a draining relay may send the client to another relay
+MAX_REDIRECTS = 3
+
 
 def eprint(*args, only_debug=False, **kwargs):
     if (debug and only_debug) or (not only_debug):
         print(*args, file=sys.stderr, **kwargs)
 
 
+async def write_stdout(queue: asyncio.Queue):
+    """
+    Write chunks from `queue` to stdout until `None` is received.
+
+    Whatever has queued up is written with one call, so a fast producer
+    costs one syscall per batch instead of one per chunk.
+    """
+    loop = asyncio.get_running_loop()
+    stdout_fd = sys.stdout.fileno()
+    sys.stdout.flush()
+    mode = os.fstat(stdout_fd).st_mode
+    if stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, sys.stdout
+        )
+        transport.set_write_buffer_limits(high=STDOUT_BUFFER_SIZE)
+        writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+        async def write(chunks):
+            writer.writelines(chunks)
+            await writer.drain()
+
+        async def flush():
+            # `drain` only waits for the buffer to go below the limit
+            transport.set_write_buffer_limits(high=0)
+            await writer.drain()
+
+    else:
+        # files and terminals cannot be used with a pipe transport,
+        # write them from a thread so the event loop is not blocked
+
+        def write_blocking(chunks):
+            written = os.writev(stdout_fd, chunks)
+            remaining = memoryview(b"".join(chunks))[written:]
+            while remaining:
+                written = os.write(stdout_fd, remaining)
+                remaining = remaining[written:]
+
+        async def write(chunks):
+            await loop.run_in_executor(None, write_blocking, chunks)
+
+        async def flush():
+            pass
+
+    try:
+        while True:
+            chunks = [await queue.get()]
+            while not queue.empty():
+                chunks.append(queue.get_nowait())
+            done = chunks[-1] is None
+            if done:
+                chunks.pop()
+            if chunks:
+                await write(chunks)
+            if done:
+                await flush()
+                return
+    finally:
+        # the pipe transport makes stdout non-blocking, which breaks
+        # `eprint` when stderr is the same pipe and would be inherited by
+        # whoever uses the file descriptor after us
+        os.set_blocking(stdout_fd, True)
+
+
+async def queue_for_stdout(
+    queue: asyncio.Queue, write_stdout_task: asyncio.Task, data
+) -> bool:
+    """
+    Queue `data` for `write_stdout`, waiting while the queue is full.
+    Returns `False` if stdout is gone.
+    """
+    if write_stdout_task.done():
+        return False
+    if not queue.full():
+        queue.put_nowait(data)
+        return True
+    # stdout is slow, wait for room without reading from the websocket
+    put_task = asyncio.create_task(queue.put(data))
+    await asyncio.wait(
+        [put_task, write_stdout_task], return_when=asyncio.FIRST_COMPLETED
+    )
+    if not put_task.done():
+        put_task.cancel()
+        return False
+    return True
+
+
 async def async_main():
     args = parser.parse_args()
     if args.relay_url is None:
         raise ValueError("relay_url is required")
     if args.secret is None:
         raise ValueError("secret is required")
-    async with connect(args.relay_url) as websocket:
-        start_message = AccessClientToRelayMessage(
-            inner=AtRStartMessage(
+    loop = asyncio.get_running_loop()
+    stdin_reader = asyncio.StreamReader()
+    stdin_protocol = asyncio.StreamReaderProtocol(stdin_reader)
+    await loop.connect_read_pipe(lambda: stdin_protocol, sys.stdin)
+    # stdin sent before the start response, a redirected session resends it
+    unacknowledged_chunks = []
+    relay_url = args.relay_url
+    for _ in range(MAX_REDIRECTS + 1):
+        relay_url = await run_session(
+            args, relay_url, stdin_reader, unacknowledged_chunks
+        )
+        if relay_url is None:
+            return
+        eprint(f"Redirected to {relay_url}")
+    eprint(f"Giving up after {MAX_REDIRECTS} redirects")
+
+
+async def run_session(args, relay_url, stdin_reader, unacknowledged_chunks):
+    """
+    Proxy stdin and stdout through the relay at `relay_url`. Returns the
+    URL to reconnect to if the relay redirects the client, else `None`.
+    """
+    async with connect(relay_url) as websocket:
+        await websocket.send(
+            encode_access_client_start_message(
                 connection_target=args.target_host_identifier,
                 target_ip=args.target_ip,
                 target_port=args.target_port,
@@ -68,68 +234,178 @@ async def async_main():
                 secret=args.secret,
             )
         )
-        await websocket.send(start_message.model_dump_json())
-        eprint(f"Sent start message: {start_message}")
-        start_response_json = await websocket.recv()
-        start_response = RelayToAccessClientMessage.model_validate_json(
-            start_response_json
-        )
-        eprint(f"Received start response: {start_response}")
-        if isinstance(start_response.inner, RtAStartOKMessage):
-            eprint(f"Received OK message: {start_response}")
-        elif isinstance(start_response.inner, RtAErrorMessage):
-            eprint(f"Received error message: {start_response}")
-            return
+        eprint(f"Sent start message for {args.target_host_identifier}")
+        started = False
 
         # start async coroutine to read stdin and send it to the server
         async def read_stdin_and_send():
-            loop = asyncio.get_event_loop()
-            reader = asyncio.StreamReader()
-            reader_protocol = asyncio.StreamReaderProtocol(reader)
-            await loop.connect_read_pipe(lambda: reader_protocol, sys.stdin)
+            for data in unacknowledged_chunks:
+                await websocket.send(encode_access_client_tcp_data_message(data))
             while True:
-                data = await reader.read(1024)
+                data = await stdin_reader.read(STDIN_READ_SIZE)
                 if not data:
                     break
-                await websocket.send(
-                    AccessClientToRelayMessage(
-                        inner=AtRTCPDataMessage(
-                            data_base64=base64.b64encode(data).decode("utf-8")
-                        )
-                    ).model_dump_json()
-                )
+                if not started:
+                    unacknowledged_chunks.append(data)
+                await websocket.send(encode_access_client_tcp_data_message(data))
 
+        # the relay reads data messages only after the connection to the
+        # target is set up, so stdin is forwarded without waiting for the
+        # start response, which saves a round trip for the first bytes
         read_stdin_and_send_task = asyncio.create_task(read_stdin_and_send())
 
+        start_response = decode_message(await websocket.recv())
+        eprint(f"Received start response: {start_response['kind']}")
+        if start_response["kind"] == "redirect":
+            # the relay is draining
+            read_stdin_and_send_task.cancel()
+            return start_response["relay_url"]
+        if start_response["kind"] == "error":
+            eprint(f"Received error message: {start_response}")
+            read_stdin_and_send_task.cancel()
+            return None
+        # only a redirect makes the client send stdin again
+        started = True
+        unacknowledged_chunks.clear()
+        if start_response["kind"] == "start_ok":
+            eprint(f"Received OK message: {start_response}")
+            early_message = None
+        else:
+            # relays that do not hold back the target's data until
+            # `start_ok` may send it first
+            early_message = start_response
+
+        stdout_queue = asyncio.Queue(maxsize=STDOUT_QUEUE_SIZE)
+        write_stdout_task = asyncio.create_task(write_stdout(stdout_queue))
+
         while True:
-            try:
-                json_data = await websocket.recv()
-            except websockets.exceptions.ConnectionClosedError as e:
-                eprint(f"Connection closed: Error: {e}")
-                break
-            except websockets.exceptions.ConnectionClosedOK as e:
-                eprint(f"Connection closed: OK: {e}")
-                break
-            message = RelayToAccessClientMessage.model_validate_json(json_data)
+            if early_message is not None:
+                message, early_message = early_message, None
+            else:
+                try:
+                    json_data = await websocket.recv()
+                except websockets.exceptions.ConnectionClosedError as e:
+                    eprint(f"Connection closed: Error: {e}")
+                    break
+                except websockets.exceptions.ConnectionClosedOK as e:
+                    eprint(f"Connection closed: OK: {e}")
+                    break
+                message = decode_message(json_data)
             eprint(f"Received message: {message}", only_debug=True)
-            if isinstance(message.inner, RtATCPDataMessage):
-                tcp_data_message = message.inner
-                eprint(
-                    f"Received TCP data message: {tcp_data_message}", only_debug=True
-                )
-                sys.stdout.buffer.write(base64.b64decode(tcp_data_message.data_base64))
-                sys.stdout.flush()
-            elif isinstance(message.inner, RtAErrorMessage):
+            if message["kind"] == "tcp_data":
+                if not await queue_for_stdout(
+                    stdout_queue,
+                    write_stdout_task,
+                    base64.b64decode(message["data_base64"]),
+                ):
+                    break
+            elif message["kind"] == "error":
                 eprint(f"Received error message: {message}")
+            elif message["kind"] == "start_ok":
+                eprint("Received OK message after data", only_debug=True)
             else:
                 eprint(f"Unknown message received: {message}")
 
         eprint("Exiting")
         read_stdin_and_send_task.cancel()
+        await queue_for_stdout(stdout_queue, write_stdout_task, None)
+        try:
+            await write_stdout_task
+        except (BrokenPipeError, ConnectionResetError) as e:
+            eprint(f"Could not write to stdout: {e}")
+        return None
+
+
+async def fanout_async_main(args) -> int:
+    """
+    Run `access-client-fanout`, returns the exit status: 0 if every target
+    answered and closed the connection in time.
+    """
+    if args.relay_url is None:
+        raise ValueError("relay_url is required")
+    if args.secret is None:
+        raise ValueError("secret is required")
+    if args.payload is not None:
+        payload = args.payload.encode()
+    elif sys.stdin.isatty():
+        payload = b""
+    else:
+        payload = sys.stdin.buffer.read()
+    fanout_message = encode_access_client_fanout_message(
+        selector=args.selector,
+        target_ip=args.target_ip,
+        target_port=args.target_port,
+        protocol=args.protocol,
+        secret=args.secret,
+        data=payload,
+        parallelism=args.parallelism,
+        timeout=args.timeout,
+    )
+    stdout = sys.stdout.buffer
+    # incomplete last line per agent
+    partial_lines = {}
+    relay_url = args.relay_url
+    for _ in range(MAX_REDIRECTS + 1):
+        async with connect(relay_url) as websocket:
+            await websocket.send(fanout_message)
+            eprint(f"Sent fan-out message for {args.selector}")
+            async for json_data in websocket:
+                message = decode_message(json_data)
+                kind = message["kind"]
+                if kind == "redirect":
+                    relay_url = message["relay_url"]
+                    eprint(f"Redirected to {relay_url}")
+                    break
+                if kind == "error":
+                    eprint(f"Received error message: {message}")
+                    return 1
+                if args.json:
+                    stdout.write(json.dumps(message).encode() + b"\n")
+                    stdout.flush()
+                elif kind == "fanout_start":
+                    eprint(f"Fan-out to {len(message['agents'])} agents")
+                elif kind == "fanout_data":
+                    agent = message["agent"]
+                    lines = (
+                        partial_lines.pop(agent, b"")
+                        + base64.b64decode(message["data_base64"])
+                    ).split(b"\n")
+                    if lines[-1]:
+                        partial_lines[agent] = lines[-1]
+                    stdout.writelines(
+                        agent.encode() + b": " + line + b"\n" for line in lines[:-1]
+                    )
+                    stdout.flush()
+                elif kind == "fanout_result":
+                    agent = message["agent"]
+                    if agent in partial_lines:
+                        stdout.write(
+                            agent.encode() + b": " + partial_lines.pop(agent) + b"\n"
+                        )
+                        stdout.flush()
+                    eprint(
+                        f"{agent}: {message['status']}, {message['received']} bytes "
+                        f"in {message['duration']:.3f} s"
+                        + (f": {message['message']}" if message["message"] else "")
+                    )
+                if kind == "fanout_done":
+                    if not args.json:
+                        eprint(f"{message['ok']} ok, {message['failed']} failed")
+                    return 0 if message["failed"] == 0 else 1
+            else:
+                eprint("Connection closed before the fan-out was done")
+                return 1
+    eprint(f"Giving up after {MAX_REDIRECTS} redirects")
+    return 1
 
 
 def main():
     asyncio.run(async_main())
 
+
+def fanout_main():
+    args = fanout_parser.parse_args()
+    sys.exit(asyncio.run(fanout_async_main(args)))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
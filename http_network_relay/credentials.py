@@ -0,0 +1,343 @@
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+debug = False
+if os.getenv("DEBUG") == "1":
+    debug = True
+
+
+def eprint(*args, only_debug=False, **kwargs):
+    if (debug and only_debug) or (not only_debug):
+        print(*args, file=sys.stderr, **kwargs)
+
+
+def hash_secret(secret: str) -> bytes:
+    # secrets are random tokens, so an unsalted digest is enough to avoid
+    # keeping them in memory in plain text and to compare in constant time
+    return hashlib.sha256(secret.encode("utf-8")).digest()
+
+
+class CredentialStore(ABC):
+    """
+    Verifies edge-agent, access-client and admin secrets.
+
+    Subclasses provide the hashed secrets through `_edge_agent_digest`,
+    `_has_access_client_digest` and `_has_admin_digest`, and report changes of the underlying data
+    through `_refresh`, which invalidates the verification cache.
+    """
+
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (kind, name, digest) -> bool
+
+    def verify_edge_agent(self, name: str, secret: str) -> bool:
+        return self._verify("edge-agent", name, hash_secret(secret))
+
+    def verify_access_client(self, secret: str) -> bool:
+        return self._verify("access-client", None, hash_secret(secret))
+
+    def verify_admin(self, secret: str) -> bool:
+        return self._verify("admin", None, hash_secret(secret))
+
+    def has_edge_agent(self, name: str) -> bool:
+        self._check_refresh()
+        return self._edge_agent_digest(name) is not None
+
+    def close(self):
+        pass
+
+    def _verify(self, kind, name, digest):
+        self._check_refresh()
+        key = (kind, name, digest)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return cached
+        if kind == "edge-agent":
+            expected = self._edge_agent_digest(name)
+            result = expected is not None and hmac.compare_digest(expected, digest)
+        elif kind == "access-client":
+            result = self._has_access_client_digest(digest)
+        else:
+            result = self._has_admin_digest(digest)
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def _check_refresh(self):
+        if self._refresh():
+            self._cache.clear()
+
+    @abstractmethod
+    def _refresh(self) -> bool:
+        pass
+
+    @abstractmethod
+    def _edge_agent_digest(self, name: str):
+        pass
+
+    @abstractmethod
+    def _has_access_client_digest(self, digest: bytes) -> bool:
+        pass
+
+    @abstractmethod
+    def _has_admin_digest(self, digest: bytes) -> bool:
+        pass
+
+
+class JSONFileCredentialStore(CredentialStore):
+    """
+    Credentials from a JSON file, see `credentials.example.json`.
+
+    The file is checked for changes at most every `reload_interval` seconds
+    and reloaded when its modification time or size changed. If the new
+    content cannot be parsed, the previous credentials stay in effect.
+    """
+
+    def __init__(self, path, reload_interval=1.0, cache_size=4096):
+        super().__init__(cache_size=cache_size)
+        self.path = path
+        self.reload_interval = reload_interval
+        self._edge_agents = {}  # name -> digest
+        self._access_client_digests = set()
+        self._admin_digests = set()
+        self._file_signature = None
+        self._last_check = 0.0
+        self._load(self._stat())
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _load(self, file_signature):
+        with open(self.path) as f:
+            credentials = json.load(f)
+        self._edge_agents = {
+            name: hash_secret(secret)
+            for name, secret in credentials.get("edge-agents", {}).items()
+        }
+        self._access_client_digests = {
+            hash_secret(secret)
+            for secret in credentials.get("access-client-secrets", [])
+        }
+        self._admin_digests = {
+            hash_secret(secret) for secret in credentials.get("admin-secrets", [])
+        }
+        self._file_signature = file_signature
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval:
+            return False
+        self._last_check = now
+        try:
+            file_signature = self._stat()
+            if file_signature == self._file_signature:
+                return False
+            self._load(file_signature)
+        except (OSError, ValueError) as e:
+            # keep serving the old credentials while the file is being replaced
+            eprint(f"Could not reload credentials from {self.path}: {e}")
+            return False
+        eprint(f"Reloaded credentials from {self.path}")
+        return True
+
+    def _edge_agent_digest(self, name):
+        return self._edge_agents.get(name)
+
+    def _has_access_client_digest(self, digest):
+        return digest in self._access_client_digests
+
+    def _has_admin_digest(self, digest):
+        return digest in self._admin_digests
+
+
+class SQLiteCredentialStore(CredentialStore):
+    """
+    Credentials in an SQLite database, for fleets too large for a JSON file.
+
+    Secrets are stored as SHA-256 digests, see `hash_secret`. Changes
+    committed by other processes are picked up through `PRAGMA data_version`,
+    so rows can be added, rotated or removed while the relay is running.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS edge_agents (
+        name TEXT PRIMARY KEY,
+        secret_sha256 BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS access_client_secrets (
+        secret_sha256 BLOB PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS admin_secrets (
+        secret_sha256 BLOB PRIMARY KEY
+    );
+    """
+
+    def __init__(self, path, cache_size=4096):
+        super().__init__(cache_size=cache_size)
+        self.path = path
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.executescript(self.SCHEMA)
+        self._data_version = self._get_data_version()
+
+    def _get_data_version(self):
+        return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _refresh(self):
+        data_version = self._get_data_version()
+        if data_version == self._data_version:
+            return False
+        self._data_version = data_version
+        return True
+
+    def _edge_agent_digest(self, name):
+        row = self._db.execute(
+            "SELECT secret_sha256 FROM edge_agents WHERE name = ?", (name,)
+        ).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def _has_access_client_digest(self, digest):
+        row = self._db.execute(
+            "SELECT 1 FROM access_client_secrets WHERE secret_sha256 = ?", (digest,)
+        ).fetchone()
+        return row is not None
+
+    def _has_admin_digest(self, digest):
+        row = self._db.execute(
+            "SELECT 1 FROM admin_secrets WHERE secret_sha256 = ?", (digest,)
+        ).fetchone()
+        return row is not None
+
+    def set_edge_agent(self, name: str, secret: str):
+        self._db.execute(
+            "INSERT OR REPLACE INTO edge_agents (name, secret_sha256) VALUES (?, ?)",
+            (name, hash_secret(secret)),
+        )
+        self._cache.clear()
+
+    def remove_edge_agent(self, name: str):
+        self._db.execute("DELETE FROM edge_agents WHERE name = ?", (name,))
+        self._cache.clear()
+
+    def add_access_client_secret(self, secret: str):
+        self._db.execute(
+            "INSERT OR IGNORE INTO access_client_secrets (secret_sha256) VALUES (?)",
+            (hash_secret(secret),),
+        )
+        self._cache.clear()
+
+    def remove_access_client_secret(self, secret: str):
+        self._db.execute(
+            "DELETE FROM access_client_secrets WHERE secret_sha256 = ?",
+            (hash_secret(secret),),
+        )
+        self._cache.clear()
+
+    def add_admin_secret(self, secret: str):
+        self._db.execute(
+            "INSERT OR IGNORE INTO admin_secrets (secret_sha256) VALUES (?)",
+            (hash_secret(secret),),
+        )
+        self._cache.clear()
+
+    def remove_admin_secret(self, secret: str):
+        self._db.execute(
+            "DELETE FROM admin_secrets WHERE secret_sha256 = ?",
+            (hash_secret(secret),),
+        )
+        self._cache.clear()
+
+    def import_json(self, path):
+        with open(path) as f:
+            credentials = json.load(f)
+        for name, secret in credentials.get("edge-agents", {}).items():
+            self.set_edge_agent(name, secret)
+        for secret in credentials.get("access-client-secrets", []):
+            self.add_access_client_secret(secret)
+        for secret in credentials.get("admin-secrets", []):
+            self.add_admin_secret(secret)
+
+    def close(self):
+        self._db.close()
+
+
+def open_credential_store(path, backend=None) -> CredentialStore:
+    if backend is None:
+        backend = "sqlite" if path.endswith((".db", ".sqlite", ".sqlite3")) else "json"
+    if backend == "json":
+        return JSONFileCredentialStore(path)
+    if backend == "sqlite":
+        return SQLiteCredentialStore(path)
+    raise ValueError(f"Unknown credentials backend: {backend}")
+
+
+parser = argparse.ArgumentParser(
+    description="Manage an SQLite credentials database for the HTTP network relay"
+)
+parser.add_argument("database", help="The SQLite database file")
+subparsers = parser.add_subparsers(dest="command", required=True)
+import_json_parser = subparsers.add_parser(
+    "import-json", help="Import all credentials from a JSON credentials file"
+)
+import_json_parser.add_argument("json_file", help="The JSON credentials file")
+set_edge_agent_parser = subparsers.add_parser(
+    "set-edge-agent", help="Add an edge-agent or rotate its secret"
+)
+set_edge_agent_parser.add_argument("name", help="The edge-agents name")
+set_edge_agent_parser.add_argument("secret", help="The edge-agents secret")
+remove_edge_agent_parser = subparsers.add_parser(
+    "remove-edge-agent", help="Remove an edge-agent"
+)
+remove_edge_agent_parser.add_argument("name", help="The edge-agents name")
+add_access_client_secret_parser = subparsers.add_parser(
+    "add-access-client-secret", help="Add an access-client secret"
+)
+add_access_client_secret_parser.add_argument("secret", help="The secret")
+remove_access_client_secret_parser = subparsers.add_parser(
+    "remove-access-client-secret", help="Remove an access-client secret"
+)
+remove_access_client_secret_parser.add_argument("secret", help="The secret")
+add_admin_secret_parser = subparsers.add_parser(
+    "add-admin-secret", help="Add a secret for the relay's admin endpoints"
+)
+add_admin_secret_parser.add_argument("secret", help="The secret")
+remove_admin_secret_parser = subparsers.add_parser(
+    "remove-admin-secret", help="Remove an admin secret"
+)
+remove_admin_secret_parser.add_argument("secret", help="The secret")
+
+
+def main():
+    args = parser.parse_args()
+    store = SQLiteCredentialStore(args.database)
+    try:
+        if args.command == "import-json":
+            store.import_json(args.json_file)
+        elif args.command == "set-edge-agent":
+            store.set_edge_agent(args.name, args.secret)
+        elif args.command == "remove-edge-agent":
+            store.remove_edge_agent(args.name)
+        elif args.command == "add-access-client-secret":
+            store.add_access_client_secret(args.secret)
+        elif args.command == "remove-access-client-secret":
+            store.remove_access_client_secret(args.secret)
+        elif args.command == "add-admin-secret":
+            store.add_admin_secret(args.secret)
+        elif args.command == "remove-admin-secret":
+            store.remove_admin_secret(args.secret)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,37 @@
 import argparse
 import asyncio
-import base64
+import binascii
+import collections
 import os
 import random
+import signal
 import socket
 import sys
+import tempfile
 import time
 
 import websockets
 from websockets.asyncio.client import ClientConnection, connect
 
+from . import profiling
 from .pydantic_models import (
     EdgeAgentToRelayMessage,
     EtRConnectionResetMessage,
     EtRInitiateConnectionErrorMessage,
     EtRInitiateConnectionOKMessage,
+    EtRPongMessage,
     EtRStartMessage,
-    EtRTCPDataMessage,
     RelayToEdgeAgentMessage,
+    RtEConnectionResetMessage,
     RtEInitiateConnectionMessage,
-    RtETCPDataMessage,
+    RtEMigrateMessage,
+    RtEPingMessage,
+)
+from .wire_format import (
+    CONNECTION_CLOSED_BY_TARGET,
+    decode_message,
+    edge_agent_tcp_data_message_prefix,
+    encode_edge_agent_tcp_data_message,
 )
 
 debug = False
@@ -55,8 +67,44 @@ parser.add_argument(
     help="The secret used to authenticate with the relay",
     default=os.getenv("HTTP_NETWORK_RELAY_CLIENT_SECRET", None),
 )
+parser.add_argument(
+    "--links",
+    help="How many WebSocket connections to keep open to the relay, "
+    "the relay spreads the streams across them",
+    type=int,
+    default=int(os.getenv("HTTP_NETWORK_RELAY_CLIENT_LINKS", "1")),
+)
+parser.add_argument(
+    "--profile-duration",
+    help="Seconds to profile for after receiving SIGUSR1",
+    type=float,
+    default=float(os.getenv("HTTP_NETWORK_RELAY_CLIENT_PROFILE_DURATION", "30")),
+)
+parser.add_argument(
+    "--profile-dir",
+    help="Directory to write the profiles taken after SIGUSR1 to",
+    default=os.getenv("HTTP_NETWORK_RELAY_CLIENT_PROFILE_DIR", tempfile.gettempdir()),
+)
+
+# kinds of profiles taken on SIGUSR1, see `profiling.profile`
+SIGNAL_PROFILE_KINDS = ["cpu", "memory", "loop-lag"]
+
+# size of the receive buffer of each target connection
+TARGET_READ_SIZE = 64 * 1024
+# encoded chunks that may wait for the relay before reading from the target
+# is paused, which pushes back to the target through TCP
+TARGET_MAX_PENDING_MESSAGES = 16
+# bytes that may wait to be written to a target; a slow target cannot push
+# back on the relay link without stalling the other streams on it, so its
+# stream is reset instead
+TARGET_MAX_WRITE_BUFFER = 8 * 1024 * 1024
+# seconds to wait for a target to accept the connection
+TARGET_CONNECT_TIMEOUT = 10
 
-active_connections = {}  # connection_id -> (tcp_reader, tcp_writer)
+active_connections = {}  # connection_id -> TargetProtocol
+# `maintain_link` tasks, and the pending migration, see `migrate`
+link_tasks = set()
+migration_target = None
 
 
 async def async_main():
@@ -65,30 +113,121 @@ async def async_main():
         raise ValueError("relay_url is required")
     if args.secret is None:
         raise ValueError("secret is required")
+    if args.links < 1:
+        raise ValueError("links must be at least 1")
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1,
+            lambda: asyncio.create_task(write_profiles(args)),
+        )
+    start_links(args, args.relay_url)
+    # links are replaced when the agent migrates to another relay
+    while link_tasks:
+        await asyncio.wait(list(link_tasks))
+
+
+def start_task(coroutine):
+    task = asyncio.create_task(coroutine)
+    link_tasks.add(task)
+    task.add_done_callback(link_tasks.discard)
+
+
+def start_links(args, relay_url):
+    for link_index in range(args.links):
+        start_task(maintain_link(args, link_index, relay_url))
+
+
+async def migrate(args, relay_url, spread):
+    """
+    Open the links to `relay_url` after a random delay of up to `spread`
+    seconds. The links to the draining relay are kept until it closes them,
+    so their streams can finish.
+    """
+    global migration_target
+    if relay_url in (args.relay_url, migration_target):
+        return
+    migration_target = relay_url
+    delay = random.uniform(0, spread)
+    eprint(f"Migrating to {relay_url} in {delay:.1f} seconds")
+    await asyncio.sleep(delay)
+    if migration_target != relay_url:
+        # a later migration replaced this one
+        return
+    migration_target = None
+    args.relay_url = relay_url
+    start_links(args, relay_url)
+
+
+async def write_profiles(args):
+    prefix = os.path.join(
+        args.profile_dir, f"edge-agent-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}"
+    )
+    results = await asyncio.gather(
+        *(
+            profiling.profile(kind, args.profile_duration)
+            for kind in SIGNAL_PROFILE_KINDS
+        ),
+        return_exceptions=True,
+    )
+    for kind, result in zip(SIGNAL_PROFILE_KINDS, results):
+        if isinstance(result, Exception):
+            eprint(f"Could not take {kind} profile: {result}")
+            continue
+        filename, content = result
+        path = f"{prefix}-{filename}"
+        with open(path, "wb") as f:
+            f.write(content)
+        eprint(f"Wrote {kind} profile to {path}")
+
+
+async def maintain_link(args, link_index, relay_url):
     connection_delay = 1
     last_connection_attempt_time = 0
     while True:
-        eprint("Connecting to server...")
+        eprint(f"Connecting link {link_index} to {relay_url}...")
         # exponential backoff
         try:
-            await connect_to_server(args)
+            await connect_to_server(args, relay_url)
         except ConnectionRefusedError as e:
             eprint(f"Connection refused: {e}")
         except Exception as e:
             eprint(f"Error: {e}")
+        if relay_url != args.relay_url:
+            eprint(f"Link {link_index} to {relay_url} closed after migration")
+            return
         if time.time() - last_connection_attempt_time >= 60:
             # if it's been more than 60 seconds since the last connection attempt
             # then the connection has been stable
             # and we can reset the connection delay
             connection_delay = 1
-        eprint(f"Connection closed, reconnecting in {connection_delay} seconds")
-        time.sleep(connection_delay)
+        # jitter, so the links and agents do not all reconnect at the same time
+        delay = connection_delay * random.uniform(1, 1.5)
+        eprint(
+            f"Connection of link {link_index} closed, reconnecting in {delay:.1f} seconds"
+        )
+        await asyncio.sleep(delay)
         connection_delay = min(2 * connection_delay, 60)
         last_connection_attempt_time = time.time()
 
 
-async def connect_to_server(args):
-    async with connect(args.relay_url) as websocket:
+async def connect_to_server(args, relay_url):
+    # connection ids of the TCP connections started through this link
+    link_connection_ids = set()
+    # connection_id -> task connecting to the target
+    link_initiations = {}
+    try:
+        await handle_link(args, relay_url, link_connection_ids, link_initiations)
+    finally:
+        for task in link_initiations.values():
+            task.cancel()
+        # the relay resets the streams of a lost link, close their TCP connections
+        for connection_id in link_connection_ids:
+            if connection_id in active_connections:
+                active_connections.pop(connection_id).transport.close()
+
+
+async def handle_link(args, relay_url, link_connection_ids, link_initiations):
+    async with connect(relay_url) as websocket:
         start_message = EdgeAgentToRelayMessage(
             inner=EtRStartMessage(name=args.name, secret=args.secret)
         )
@@ -97,59 +236,209 @@ async def connect_to_server(args):
 
         while True:
             try:
-                json_data = await websocket.recv()
+                json_data = await websocket.recv(decode=False)
             except websockets.exceptions.ConnectionClosedError as e:
                 eprint(f"Connection closed with error: {e}")
                 break
             except websockets.exceptions.ConnectionClosedOK as e:
                 eprint(f"Connection closed OK: {e}")
                 break
-            message = RelayToEdgeAgentMessage.model_validate_json(json_data)
+            inner = decode_message(json_data)
+            if inner["kind"] == "tcp_data":
+                # data messages skip the models, see `TargetProtocol`
+                await write_to_target(inner, websocket, link_connection_ids)
+                continue
+            message = RelayToEdgeAgentMessage.model_validate({"inner": inner})
             eprint(f"Received message: {message}", only_debug=True)
             if isinstance(message.inner, RtEInitiateConnectionMessage):
                 eprint(f"Received initiate connection message: {message}")
-                try:
-                    await initiate_connection(message.inner, websocket)
-                except Exception as e:
-                    eprint(f"Error while initiating connection: {e}")
-                    # send an error message back
-                    await websocket.send(
-                        EdgeAgentToRelayMessage(
-                            inner=EtRInitiateConnectionErrorMessage(
-                                message=str(e),
-                                connection_id=message.inner.connection_id,
-                            )
-                        ).model_dump_json()
+                # connecting may take a while, the link keeps serving the others
+                connection_id = message.inner.connection_id
+                link_connection_ids.add(connection_id)
+                link_initiations[connection_id] = asyncio.create_task(
+                    handle_initiate_connection(
+                        message.inner, websocket, link_connection_ids, link_initiations
                     )
-            elif isinstance(message.inner, RtETCPDataMessage):
-                tcp_data_message = message.inner
-                eprint(
-                    f"Received TCP data message: {tcp_data_message}", only_debug=True
                 )
-                # associate the connection_id with the websocket
-                if tcp_data_message.connection_id not in active_connections:
-                    eprint(f"Unknown connection_id: {tcp_data_message.connection_id}")
-                    continue
-                reader, writer = active_connections[tcp_data_message.connection_id]
-                writer.write(base64.b64decode(tcp_data_message.data_base64))
-                try:
-                    await writer.drain()
-                except ConnectionResetError:
-                    eprint(f"Connection reset while writing data")
-                    writer.close()
-                    del active_connections[tcp_data_message.connection_id]
-                    await websocket.send(
-                        EdgeAgentToRelayMessage(
-                            inner=EtRConnectionResetMessage(
-                                message="Connection reset while writing data",
-                                connection_id=tcp_data_message.connection_id,
-                            )
-                        ).model_dump_json()
+            elif isinstance(message.inner, RtEPingMessage):
+                await websocket.send(
+                    EdgeAgentToRelayMessage(
+                        inner=EtRPongMessage(
+                            ping_id=message.inner.ping_id,
+                            sent_at=message.inner.sent_at,
+                        )
+                    ).model_dump_json()
+                )
+            elif isinstance(message.inner, RtEConnectionResetMessage):
+                eprint(f"Received connection reset message: {message}")
+                connection_id = message.inner.connection_id
+                link_connection_ids.discard(connection_id)
+                if connection_id in link_initiations:
+                    link_initiations.pop(connection_id).cancel()
+                if connection_id in active_connections:
+                    active_connections.pop(connection_id).transport.close()
+            elif isinstance(message.inner, RtEMigrateMessage):
+                eprint(f"Received migrate message: {message}")
+                if message.inner.relay_url is not None:
+                    start_task(
+                        migrate(args, message.inner.relay_url, message.inner.spread)
                     )
             else:
                 eprint(f"Unknown message received: {message}")
 
 
+async def handle_initiate_connection(
+    message: RtEInitiateConnectionMessage,
+    websocket: ClientConnection,
+    link_connection_ids,
+    link_initiations,
+):
+    try:
+        await initiate_connection(message, websocket)
+    except Exception as e:
+        eprint(f"Error while initiating connection: {e}")
+        link_connection_ids.discard(message.connection_id)
+        # send an error message back
+        try:
+            await websocket.send(
+                EdgeAgentToRelayMessage(
+                    inner=EtRInitiateConnectionErrorMessage(
+                        message=str(e),
+                        connection_id=message.connection_id,
+                    )
+                ).model_dump_json()
+            )
+        except websockets.exceptions.ConnectionClosed:
+            pass
+    finally:
+        link_initiations.pop(message.connection_id, None)
+
+
+async def write_to_target(tcp_data_message: dict, websocket, link_connection_ids):
+    connection_id = tcp_data_message["connection_id"]
+    eprint(f"Received TCP data message for {connection_id}", only_debug=True)
+    if connection_id not in active_connections:
+        eprint(f"Unknown connection_id: {connection_id}")
+        return
+    protocol = active_connections[connection_id]
+    if protocol.transport.is_closing():
+        eprint(f"Connection reset while writing data")
+        del active_connections[connection_id]
+        link_connection_ids.discard(connection_id)
+        await websocket.send(
+            EdgeAgentToRelayMessage(
+                inner=EtRConnectionResetMessage(
+                    message="Connection reset while writing data",
+                    connection_id=connection_id,
+                )
+            ).model_dump_json()
+        )
+        return
+    protocol.transport.write(binascii.a2b_base64(tcp_data_message["data_base64"]))
+    if protocol.transport.get_write_buffer_size() > TARGET_MAX_WRITE_BUFFER:
+        eprint(f"Target of {connection_id} is not reading, resetting the connection")
+        # reported to the relay by `send_to_relay`
+        protocol.lost_reason = "Target is not reading the data sent to it"
+        protocol.transport.abort()
+
+
+class TargetProtocol(asyncio.BufferedProtocol):
+    """
+    The connection to a target. Data is received into one preallocated
+    buffer and base64-encoded straight from it, so a chunk does not pass
+    through intermediate `bytes`, `str` and model objects on its way to the
+    relay; see `encode_edge_agent_tcp_data_message` for the copy that is left.
+    """
+
+    def __init__(self, connection_id, websocket: ClientConnection, close_on_eof):
+        self.connection_id = connection_id
+        self.websocket = websocket
+        self.close_on_eof = close_on_eof
+        self.message_prefix = edge_agent_tcp_data_message_prefix(connection_id)
+        self.buffer = memoryview(bytearray(TARGET_READ_SIZE))
+        self.transport = None
+        # encoded messages for the relay, `None` once the target is closed
+        self.outgoing = collections.deque()
+        self.has_outgoing = asyncio.Event()
+        self.reading_paused = False
+        # sent to the relay once the connection is closed
+        self.lost_reason = None
+        self.send_to_relay_task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        self.outgoing.append(
+            encode_edge_agent_tcp_data_message(
+                self.message_prefix, self.buffer[:nbytes]
+            )
+        )
+        self.has_outgoing.set()
+        if len(self.outgoing) >= TARGET_MAX_PENDING_MESSAGES:
+            self.transport.pause_reading()
+            self.reading_paused = True
+
+    def eof_received(self):
+        # keep the connection open for writing, like `asyncio.open_connection`,
+        # unless asked to close it, then `send_to_relay` tells the relay
+        return not self.close_on_eof
+
+    def connection_lost(self, exc):
+        # unless already set when the agent closed it, see `write_to_target`
+        if self.lost_reason is None and exc is None:
+            self.lost_reason = CONNECTION_CLOSED_BY_TARGET
+        elif self.lost_reason is None:
+            self.lost_reason = f"Connection to target lost: {exc}"
+        self.outgoing.append(None)
+        self.has_outgoing.set()
+
+    async def send_to_relay(self):
+        """
+        Send the received data to the relay, started once the relay knows
+        about the connection.
+        """
+        while True:
+            if not self.outgoing:
+                self.has_outgoing.clear()
+                await self.has_outgoing.wait()
+            message = self.outgoing.popleft()
+            if message is None:
+                await self.report_closed()
+                return
+            if (
+                self.reading_paused
+                and len(self.outgoing) < TARGET_MAX_PENDING_MESSAGES // 2
+            ):
+                self.transport.resume_reading()
+                self.reading_paused = False
+            try:
+                await self.websocket.send(message, text=True)
+            except websockets.exceptions.ConnectionClosed:
+                self.transport.close()
+                return
+
+    async def report_closed(self):
+        if active_connections.get(self.connection_id) is not self:
+            # closed by the relay
+            return
+        del active_connections[self.connection_id]
+        try:
+            await self.websocket.send(
+                EdgeAgentToRelayMessage(
+                    inner=EtRConnectionResetMessage(
+                        message=self.lost_reason,
+                        connection_id=self.connection_id,
+                    )
+                ).model_dump_json()
+            )
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
 async def initiate_connection(
     message: RtEInitiateConnectionMessage, server_websocket: ClientConnection
 ):
@@ -159,10 +448,21 @@ async def initiate_connection(
     if message.protocol != "tcp":
         eprint(f"Unsupported protocol: {message.protocol}")
         raise NotImplementedError(f"Unsupported protocol: {message.protocol}")
-    reader, writer = await asyncio.open_connection(
-        message.target_ip, message.target_port
-    )
-    active_connections[message.connection_id] = (reader, writer)
+    try:
+        async with asyncio.timeout(TARGET_CONNECT_TIMEOUT):
+            _transport, protocol = await asyncio.get_running_loop().create_connection(
+                lambda: TargetProtocol(
+                    message.connection_id, server_websocket, message.close_on_eof
+                ),
+                message.target_ip,
+                message.target_port,
+            )
+    except TimeoutError:
+        raise TimeoutError(
+            f"Connection to {message.target_ip}:{message.target_port} "
+            f"timed out after {TARGET_CONNECT_TIMEOUT} seconds"
+        ) from None
+    active_connections[message.connection_id] = protocol
     eprint(f"Connected to {message.target_ip}:{message.target_port}")
     # send OK message back
     await server_websocket.send(
@@ -171,22 +471,8 @@ async def initiate_connection(
         ).model_dump_json()
     )
 
-    # start async coroutine to read from the TCP connection and send it to the server
-    async def read_from_tcp_and_send():
-        while True:
-            data = await reader.read(1024)
-            if not data:
-                break
-            await server_websocket.send(
-                EdgeAgentToRelayMessage(
-                    inner=EtRTCPDataMessage(
-                        connection_id=message.connection_id,
-                        data_base64=base64.b64encode(data).decode("utf-8"),
-                    )
-                ).model_dump_json()
-            )
-
-    read_from_tcp_and_send_task = asyncio.create_task(read_from_tcp_and_send())
+    # data received before the OK message waited in `protocol.outgoing`
+    protocol.send_to_relay_task = asyncio.create_task(protocol.send_to_relay())
 
 
 def main():
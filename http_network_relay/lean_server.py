@@ -0,0 +1,202 @@
+import asyncio
+import inspect
+import json
+import os
+import sys
+from contextlib import nullcontext
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+from fastapi import HTTPException, WebSocketDisconnect
+from fastapi import Response as FastAPIResponse
+from websockets.asyncio.server import ServerConnection, serve
+from websockets.datastructures import Headers
+from websockets.exceptions import ConnectionClosed
+from websockets.http11 import Response
+
+debug = False
+if os.getenv("DEBUG") == "1":
+    debug = True
+
+
+def eprint(*args, only_debug=False, **kwargs):
+    if (debug and only_debug) or (not only_debug):
+        print(*args, file=sys.stderr, **kwargs)
+
+
+class LeanWebSocket:
+    """
+    Exposes a `websockets` server connection with the subset of the
+    Starlette `WebSocket` interface used by the relay routes, so the same
+    route functions serve both the FastAPI app and the lean server.
+    """
+
+    def __init__(self, connection: ServerConnection):
+        self.connection = connection
+
+    async def accept(self):
+        # the opening handshake is completed by `websockets` before the
+        # handler is called
+        pass
+
+    async def receive_text(self) -> str:
+        try:
+            return await self.connection.recv(decode=True)
+        except ConnectionClosed as e:
+            code = e.rcvd.code if e.rcvd is not None else 1006
+            raise WebSocketDisconnect(code=code) from e
+
+    async def send_text(self, data: str):
+        await self.connection.send(data)
+
+    async def close(self, code: int = 1000):
+        await self.connection.close(code)
+
+
+def json_response(status: int, payload, headers=()) -> Response:
+    body = json.dumps(payload).encode()
+    headers = Headers(
+        [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+            *headers,
+        ]
+    )
+    return Response(status, HTTPStatus(status).phrase, headers, body)
+
+
+async def endpoint_response(endpoint, authorization, kwargs) -> Response:
+    try:
+        payload = await endpoint(authorization=authorization, **kwargs)
+    except HTTPException as e:
+        return json_response(e.status_code, {"detail": e.detail})
+    if isinstance(payload, FastAPIResponse):
+        headers = Headers(payload.headers.items())
+        return Response(
+            payload.status_code,
+            HTTPStatus(payload.status_code).phrase,
+            headers,
+            payload.body,
+        )
+    return json_response(HTTPStatus.OK, payload)
+
+
+def run(routes, host, port, **kwargs):
+    """
+    Run `serve_routes` on a new event loop, using uvloop if installed.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        loop_factory = None
+    else:
+        loop_factory = uvloop.new_event_loop
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(serve_routes(routes, host, port, **kwargs))
+
+
+async def serve_routes(
+    routes,
+    host,
+    port,
+    http_routes=None,
+    lifespan=None,
+    shutdown_event=None,
+    open_timeout=10,
+    max_size=16 * 1024 * 1024,
+    unfetched_response_ttl=300,
+):
+    """
+    Serve the WebSocket `routes` (path -> route function taking a
+    `LeanWebSocket`) directly with `websockets`.
+
+    `http_routes` maps paths to FastAPI GET endpoints whose arguments are
+    the `authorization` header and query parameters, which are passed as
+    strings. They are answered during the opening handshake, which has to
+    finish within `open_timeout`. An endpoint that takes longer, like a
+    long profile, keeps running and is answered with 503 and `Retry-After`,
+    the same request made again waits for it and gets its response. A
+    response not fetched within `unfetched_response_ttl` seconds is dropped.
+
+    `lifespan` is entered around serving like FastAPI's, the server stops
+    when `shutdown_event` is set. `max_size` limits incoming messages like
+    uvicorn's `ws_max_size`, whose default it shares.
+    """
+    http_routes = http_routes or {}
+    # (path, query, authorization) -> task answering the request
+    running_responses = {}
+
+    def forget_response(key, task):
+        if running_responses.get(key) is task:
+            del running_responses[key]
+
+    async def process_request(connection, request):
+        url = urlsplit(request.path)
+        path = url.path
+        if path in http_routes:
+            endpoint = http_routes[path]
+            parameters = inspect.signature(endpoint).parameters
+            kwargs = {
+                key: value
+                for key, value in parse_qsl(url.query)
+                if key in parameters and key != "authorization"
+            }
+            missing = [
+                name
+                for name, parameter in parameters.items()
+                if parameter.default is inspect.Parameter.empty and name not in kwargs
+            ]
+            if missing:
+                return json_response(
+                    HTTPStatus.UNPROCESSABLE_ENTITY,
+                    {"detail": f"Missing query parameters: {', '.join(missing)}"},
+                )
+            authorization = request.headers.get("Authorization")
+            # the secret is part of the key, only its sender gets the response
+            key = (path, url.query, authorization)
+            task = running_responses.get(key)
+            if task is None:
+                task = asyncio.create_task(
+                    endpoint_response(endpoint, authorization, kwargs)
+                )
+                running_responses[key] = task
+                task.add_done_callback(
+                    lambda task: asyncio.get_running_loop().call_later(
+                        unfetched_response_ttl, forget_response, key, task
+                    )
+                )
+            try:
+                # leave time for sending the response within `open_timeout`
+                response = await asyncio.wait_for(
+                    asyncio.shield(task), open_timeout / 2
+                )
+            except TimeoutError:
+                return json_response(
+                    HTTPStatus.SERVICE_UNAVAILABLE,
+                    {"detail": "Still running, repeat the request for the response"},
+                    headers=[("Retry-After", "1")],
+                )
+            forget_response(key, task)
+            return response
+        if path not in routes:
+            return connection.respond(HTTPStatus.NOT_FOUND, "Not Found\n")
+        return None
+
+    async def handler(connection: ServerConnection):
+        route = routes[connection.request.path.split("?", 1)[0]]
+        await route(LeanWebSocket(connection))
+
+    async with serve(
+        handler,
+        host,
+        port,
+        process_request=process_request,
+        open_timeout=open_timeout,
+        max_size=max_size,
+    ) as server:
+        eprint(f"Lean relay server running on ws://{host}:{port}")
+        async with lifespan(None) if lifespan else nullcontext():
+            if shutdown_event is None:
+                await server.serve_forever()
+            else:
+                await shutdown_event.wait()
@@ -2,45 +2,115 @@
 import argparse
 import asyncio
 from contextlib import asynccontextmanager
-import json
+from fnmatch import fnmatchcase
 import os
+import random
+import signal
 import sys
+import time
 import uuid
 from typing import Union
 
 import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import (
+    FastAPI,
+    Header,
+    HTTPException,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+)
 
+from . import profiling
+from .credentials import CredentialStore, open_credential_store
+from .profiling import STAGE_TIMERS, ProfilingBusyError
 from .pydantic_models import (
     AccessClientToRelayMessage,
+    AtRFanoutMessage,
     AtRStartMessage,
     AtRTCPDataMessage,
     EdgeAgentToRelayMessage,
     EtRConnectionResetMessage,
     EtRInitiateConnectionErrorMessage,
     EtRInitiateConnectionOKMessage,
+    EtRPongMessage,
     EtRStartMessage,
     EtRTCPDataMessage,
     RelayToAccessClientMessage,
     RelayToEdgeAgentMessage,
     RtAErrorMessage,
+    RtAFanoutDataMessage,
+    RtAFanoutDoneMessage,
+    RtAFanoutResultMessage,
+    RtAFanoutStartMessage,
     RtAStartOKMessage,
     RtATCPDataMessage,
+    RtARedirectMessage,
+    RtEConnectionResetMessage,
     RtEInitiateConnectionMessage,
+    RtEMigrateMessage,
+    RtEPingMessage,
     RtETCPDataMessage,
 )
+from .wire_format import CONNECTION_CLOSED_BY_TARGET, decode_message
 
 CREDENTIALS_FILE = os.getenv("HTTP_NETWORK_RELAY_CREDENTIALS_FILE", "credentials.json")
-CREDENTIALS = None
+CREDENTIALS_BACKEND = os.getenv("HTTP_NETWORK_RELAY_CREDENTIALS_BACKEND", None)
+CREDENTIAL_STORE: CredentialStore = None
+
+HEARTBEAT_INTERVAL = float(os.getenv("HTTP_NETWORK_RELAY_HEARTBEAT_INTERVAL", "10"))
+HEARTBEAT_TIMEOUT = float(os.getenv("HTTP_NETWORK_RELAY_HEARTBEAT_TIMEOUT", "30"))
+MAX_LINKS_PER_AGENT = int(os.getenv("HTTP_NETWORK_RELAY_MAX_LINKS_PER_AGENT", "8"))
+# largest WebSocket message accepted, uvicorn's default, the data messages
+# of `access-client` and `edge-agent` carry at most 64 KiB
+MAX_MESSAGE_SIZE = int(
+    os.getenv("HTTP_NETWORK_RELAY_MAX_MESSAGE_SIZE", str(16 * 1024 * 1024))
+)
+
+MAX_FANOUT_PARALLELISM = int(os.getenv("HTTP_NETWORK_RELAY_MAX_FANOUT_PARALLELISM", "256"))
+
+DRAIN_REDIRECT_URL = os.getenv("HTTP_NETWORK_RELAY_DRAIN_REDIRECT_URL", None)
+DRAIN_SPREAD = float(os.getenv("HTTP_NETWORK_RELAY_DRAIN_SPREAD", "30"))
+DRAIN_TIMEOUT = float(os.getenv("HTTP_NETWORK_RELAY_DRAIN_TIMEOUT", "600"))
+
+draining = False
+drain_redirect_url = None
+# until then, a draining relay starts the streams of agents that are still
+# linked to it, they may not have reached the new relay yet
+drain_migration_until = 0
+drain_task = None
+# set when the relay has drained and the server should stop
+shutdown_event = asyncio.Event()
+uvicorn_server = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if hasattr(signal, "SIGUSR2"):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR2,
+            lambda: start_drain(DRAIN_REDIRECT_URL, DRAIN_SPREAD, DRAIN_TIMEOUT),
+        )
+
+    async def stop_uvicorn_on_shutdown():
+        await shutdown_event.wait()
+        if uvicorn_server is not None:
+            uvicorn_server.should_exit = True
+
+    stop_task = asyncio.create_task(stop_uvicorn_on_shutdown())
+    yield
+    stop_task.cancel()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 agent_connections = []
-registered_agent_connections = {}  # name -> connection
+registered_agent_connections = {}  # name -> list of AgentLink
+next_link_id = 0
 access_client_connections = []
 
-initiate_connection_answer_queue = asyncio.Queue()
+# connection_id -> (AgentLink, future for the agent's answer)
+pending_initiations = {}
 
 debug = False
 if os.getenv("DEBUG") == "1":
@@ -52,6 +122,346 @@ def eprint(*args, only_debug=False, **kwargs):
         print(*args, file=sys.stderr, **kwargs)
 
 
+class AgentLink:
+    """
+    One registered WebSocket connection of an edge agent, together with
+    its liveness, round trip time and the streams assigned to it.
+
+    The RTT is smoothed and its variation tracked like TCP does (RFC 6298),
+    the variation is reported as jitter.
+    """
+
+    def __init__(self, name, websocket, link_id):
+        self.name = name
+        self.websocket = websocket
+        self.link_id = link_id
+        self.connected_at = time.time()
+        self.last_seen = time.monotonic()
+        self.awaiting_pong_since = None
+        self.next_ping_id = 0
+        self.rtt = None
+        self.srtt = None
+        self.rttvar = None
+        self.heartbeat_task = None
+        self.streams = set()  # connection ids
+
+    def record_pong(self, pong: EtRPongMessage):
+        now = time.monotonic()
+        self.last_seen = now
+        if pong.ping_id == self.next_ping_id - 1:
+            # otherwise this answers an older ping, the newest is still outstanding
+            self.awaiting_pong_since = None
+        self.rtt = now - pong.sent_at
+        if self.srtt is None:
+            self.srtt = self.rtt
+            self.rttvar = self.rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - self.rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * self.rtt
+
+    def make_ping(self) -> RtEPingMessage:
+        now = time.monotonic()
+        if self.awaiting_pong_since is None:
+            self.awaiting_pong_since = now
+        ping = RtEPingMessage(ping_id=self.next_ping_id, sent_at=now)
+        self.next_ping_id += 1
+        return ping
+
+    @property
+    def state(self):
+        if (
+            self.awaiting_pong_since is not None
+            and time.monotonic() - self.awaiting_pong_since > HEARTBEAT_INTERVAL
+        ):
+            return "unresponsive"
+        if self.srtt is None:
+            return "connecting"
+        return "healthy"
+
+    def report(self):
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 3)
+
+        return {
+            "link_id": self.link_id,
+            "status": self.state,
+            "connected_at": self.connected_at,
+            "last_seen_seconds_ago": round(time.monotonic() - self.last_seen, 3),
+            "rtt_ms": ms(self.rtt),
+            "srtt_ms": ms(self.srtt),
+            "jitter_ms": ms(self.rttvar),
+            "streams": len(self.streams),
+        }
+
+
+def report_agent(name, links):
+    link_reports = [link.report() for link in links]
+    states = {link_report["status"] for link_report in link_reports}
+    srtts = [link_report["srtt_ms"] for link_report in link_reports]
+    srtts = [srtt for srtt in srtts if srtt is not None]
+    for state in ("healthy", "connecting", "unresponsive"):
+        if state in states:
+            break
+    return {
+        "name": name,
+        "status": state,
+        "srtt_ms": min(srtts, default=None),
+        "streams": sum(link_report["streams"] for link_report in link_reports),
+        "links": link_reports,
+    }
+
+
+def select_link(name, exclude=()) -> Union[AgentLink, None]:
+    """
+    Pick the link of agent `name` for a new stream: the one with the fewest
+    streams, ties broken by the lower smoothed RTT. Unresponsive links are
+    only used if no other link is left.
+    """
+    links = [
+        link for link in registered_agent_connections.get(name, []) if link not in exclude
+    ]
+    responsive_links = [link for link in links if link.state != "unresponsive"]
+    return min(
+        responsive_links or links,
+        key=lambda link: (
+            len(link.streams),
+            link.srtt if link.srtt is not None else float("inf"),
+        ),
+        default=None,
+    )
+
+
+async def heartbeat(link: AgentLink):
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        if time.monotonic() - link.last_seen > HEARTBEAT_TIMEOUT:
+            eprint(f"No heartbeat from client, evicting: {link.name} link {link.link_id}")
+            await unregister_link(link, "Edge agent stopped responding")
+            try:
+                await link.websocket.close()
+            except Exception as e:
+                eprint(f"Error while closing connection of {link.name}: {e}")
+            return
+        try:
+            await link.websocket.send_text(
+                RelayToEdgeAgentMessage(inner=link.make_ping()).model_dump_json()
+            )
+        except Exception as e:
+            eprint(f"Could not send ping to {link.name}, evicting: {e}")
+            await unregister_link(link, "Edge agent disconnected")
+            try:
+                await link.websocket.close()
+            except Exception as e:
+                eprint(f"Error while closing connection of {link.name}: {e}")
+            return
+
+
+class LinkLostError(Exception):
+    pass
+
+
+class InitiateConnectionError(Exception):
+    pass
+
+
+async def unregister_link(link: AgentLink, reason: str):
+    links = registered_agent_connections.get(link.name, [])
+    if link in links:
+        links.remove(link)
+        if not links:
+            del registered_agent_connections[link.name]
+    if link.heartbeat_task is not None and link.heartbeat_task is not (
+        asyncio.current_task()
+    ):
+        link.heartbeat_task.cancel()
+    for connection_id in list(link.streams):
+        pending_link, answer = pending_initiations.get(connection_id, (None, None))
+        if pending_link is link:
+            # not started yet, `initiate_connection` retries on another link
+            if not answer.done():
+                answer.set_exception(LinkLostError(reason))
+            continue
+        # established streams cannot move, the data in flight on this link is lost
+        link.streams.discard(connection_id)
+        if connection_id not in active_connections:
+            continue
+        _agent_connection, access_client_connection = active_connections.pop(
+            connection_id
+        )
+        try:
+            await access_client_connection.send_text(
+                RelayToAccessClientMessage(
+                    inner=RtAErrorMessage(message=reason)
+                ).model_dump_json()
+            )
+            await access_client_connection.close()
+        except Exception as e:
+            eprint(f"Error while closing access client connection {connection_id}: {e}")
+
+
+async def reset_stream(connection_id, connection_target, reason):
+    """
+    Forget a stream the access client no longer wants and tell the agent to
+    close its connection to the target.
+    """
+    active_connections.pop(connection_id, None)
+    for link in registered_agent_connections.get(connection_target, []):
+        if connection_id not in link.streams:
+            continue
+        link.streams.discard(connection_id)
+        try:
+            await link.websocket.send_text(
+                RelayToEdgeAgentMessage(
+                    inner=RtEConnectionResetMessage(
+                        message=reason, connection_id=connection_id
+                    )
+                ).model_dump_json()
+            )
+        except Exception as e:
+            eprint(f"Could not reset {connection_id} on {link.name}: {e}")
+
+
+def bearer_secret(authorization: Union[str, None]) -> Union[str, None]:
+    scheme, _, secret = (authorization or "").partition(" ")
+    return secret if scheme.lower() == "bearer" else None
+
+
+def check_access_client_authorization(authorization: Union[str, None]) -> bool:
+    secret = bearer_secret(authorization)
+    return secret is not None and CREDENTIAL_STORE.verify_access_client(secret)
+
+
+def check_admin_authorization(authorization: Union[str, None]) -> bool:
+    secret = bearer_secret(authorization)
+    return secret is not None and CREDENTIAL_STORE.verify_admin(secret)
+
+
+@app.get("/agents")
+async def get_agents(authorization: Union[str, None] = Header(default=None)):
+    if not check_access_client_authorization(authorization):
+        raise HTTPException(status_code=401, detail="Invalid access client secret")
+    return {
+        "agents": [
+            report_agent(name, links)
+            for name, links in registered_agent_connections.items()
+        ]
+    }
+
+
+@app.get("/admin/profile")
+async def get_admin_profile(
+    kind: str,
+    duration: float = 10,
+    authorization: Union[str, None] = Header(default=None),
+):
+    """
+    Profile the relay for `duration` seconds and download the result, see
+    `profiling.profile` for the kinds and file formats.
+    """
+    if not check_admin_authorization(authorization):
+        raise HTTPException(status_code=401, detail="Invalid admin secret")
+    try:
+        filename, content = await profiling.profile(kind, float(duration))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ProfilingBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(
+        content=content,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def start_drain(redirect_url, spread, timeout) -> bool:
+    """
+    Stop accepting new streams and shut down once the existing ones are
+    done. Returns `False` if the relay is already draining.
+    """
+    global draining, drain_redirect_url, drain_migration_until, drain_task
+    if draining:
+        return False
+    draining = True
+    drain_redirect_url = redirect_url
+    if redirect_url is not None:
+        drain_migration_until = time.monotonic() + spread
+    drain_task = asyncio.create_task(drain(redirect_url, spread, timeout))
+    return True
+
+
+async def drain(redirect_url, spread, timeout):
+    eprint(
+        f"Draining: {len(active_connections)} streams, "
+        f"{len(registered_agent_connections)} agents, redirecting to {redirect_url}"
+    )
+    # agents with a new relay to go to open their new links right away,
+    # spread over `spread` seconds so the new relay is not hit all at once
+    migrate_message = RelayToEdgeAgentMessage(
+        inner=RtEMigrateMessage(
+            relay_url=(
+                None
+                if redirect_url is None
+                else redirect_url.rstrip("/") + "/ws_for_edge_agents"
+            ),
+            spread=spread,
+        )
+    ).model_dump_json()
+    links = [link for links in registered_agent_connections.values() for link in links]
+    for link in links:
+        try:
+            await link.websocket.send_text(migrate_message)
+        except Exception as e:
+            eprint(f"Could not send migrate message to {link.name}: {e}")
+
+    deadline = time.monotonic() + timeout
+    # keep the links open until the agents had time to connect to the new relay
+    links_needed_until = time.monotonic() + (spread if redirect_url is not None else 0)
+    while (
+        active_connections or time.monotonic() < links_needed_until
+    ) and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+    if active_connections:
+        eprint(f"Drain timed out, closing {len(active_connections)} streams")
+
+    links = [link for links in registered_agent_connections.values() for link in links]
+    random.shuffle(links)
+    for link in links:
+        await unregister_link(link, "Relay is shutting down")
+        try:
+            await link.websocket.close()
+        except Exception as e:
+            eprint(f"Error while closing connection of {link.name}: {e}")
+        if redirect_url is None:
+            # the agents reconnect when their links close, spread that out
+            await asyncio.sleep(spread / len(links))
+    eprint("Drained, shutting down")
+    shutdown_event.set()
+
+
+@app.post("/admin/drain")
+async def post_admin_drain(
+    redirect_url: Union[str, None] = None,
+    spread: Union[float, None] = None,
+    timeout: Union[float, None] = None,
+    authorization: Union[str, None] = Header(default=None),
+):
+    """
+    Start draining the relay, `redirect_url` is the base URL of the relay
+    that takes over, e.g. `wss://relay-2.example.com`.
+    """
+    if not check_admin_authorization(authorization):
+        raise HTTPException(status_code=401, detail="Invalid admin secret")
+    start_drain(
+        redirect_url if redirect_url is not None else DRAIN_REDIRECT_URL,
+        spread if spread is not None else DRAIN_SPREAD,
+        timeout if timeout is not None else DRAIN_TIMEOUT,
+    )
+    return {
+        "draining": draining,
+        "redirect_url": drain_redirect_url,
+        "streams": len(active_connections),
+        "agents": len(registered_agent_connections),
+    }
 
 
 @app.websocket("/ws_for_edge_agents")
@@ -66,84 +476,109 @@ async def ws_for_edge_agents(websocket: WebSocket):
     if not isinstance(start_message, EtRStartMessage):
         eprint(f"Unknown message received from client: {start_message}")
         return
-    #  check if we know the client
-    if start_message.name not in CREDENTIALS["edge-agents"]:
-        eprint(f"Unknown client: {start_message.name}")
+    # check if we know the client and the secret is correct
+    if not CREDENTIAL_STORE.verify_edge_agent(start_message.name, start_message.secret):
+        if CREDENTIAL_STORE.has_edge_agent(start_message.name):
+            eprint(f"Invalid secret for client: {start_message.name}")
+        else:
+            eprint(f"Unknown client: {start_message.name}")
         # close the connection
         await websocket.close()
         return
 
-    # check if the secret is correct
-    if CREDENTIALS["edge-agents"][start_message.name] != start_message.secret:
-        eprint(f"Invalid secret for client: {start_message.name}")
-        # close the connection
-        await websocket.close()
+    if draining:
+        eprint(f"Draining, not accepting client: {start_message.name}")
+        # try again later
+        await websocket.close(code=1013)
         return
 
-    # check if the client is already registered
-    if start_message.name in registered_agent_connections:
-        eprint(f"Client already registered: {start_message.name}")
+    # an agent may open several links, see `select_link`
+    links = registered_agent_connections.setdefault(start_message.name, [])
+    if len(links) >= MAX_LINKS_PER_AGENT:
+        eprint(f"Client already registered with {len(links)} links: {start_message.name}")
         # close the connection
         await websocket.close()
         return
 
-    registered_agent_connections[start_message.name] = websocket
-    eprint(f"Registered client connection: {start_message.name}")
+    global next_link_id
+    link = AgentLink(start_message.name, websocket, next_link_id)
+    next_link_id += 1
+    links.append(link)
+    link.heartbeat_task = asyncio.create_task(heartbeat(link))
+    eprint(f"Registered client connection: {start_message.name} link {link.link_id}")
 
-    while True:
-        try:
-            json_data = await websocket.receive_text()
-        except WebSocketDisconnect:
-            eprint(f"Client disconnected: {start_message.name}")
-            del registered_agent_connections[start_message.name]
-            break
-        message = EdgeAgentToRelayMessage.model_validate_json(json_data)
-        eprint(f"Message received from client: {message}", only_debug=True)
-        if isinstance(message.inner, EtRInitiateConnectionErrorMessage):
-            eprint(f"Received initiate connection error message from client: {message}")
-            await initiate_connection_answer_queue.put(message.inner)
-        elif isinstance(message.inner, EtRInitiateConnectionOKMessage):
-            eprint(f"Received initiate connection OK message from client: {message}")
-            await initiate_connection_answer_queue.put(message.inner)
-        elif isinstance(message.inner, EtRTCPDataMessage):
-            eprint(f"Received TCP data message from client: {message}", only_debug=True)
-            tcp_data_message = message.inner
-            if tcp_data_message.connection_id not in active_connections:
-                eprint(f"Unknown connection_id: {tcp_data_message.connection_id}")
-                continue
-            _agent_connection, access_client_connection = active_connections[
-                tcp_data_message.connection_id
-            ]
-            await access_client_connection.send_text(
-                RelayToAccessClientMessage(
-                    inner=RtATCPDataMessage(
-                        data_base64=tcp_data_message.data_base64,
-                    )
-                ).model_dump_json()
-            )
-        elif isinstance(message.inner, EtRConnectionResetMessage):
-            eprint(f"Received connection reset message from client: {message}")
-            connection_reset_message = message.inner
-            if connection_reset_message.connection_id not in active_connections:
+    # whatever ends the loop, a link that is gone must not get new streams
+    try:
+        while True:
+            try:
+                json_data = await websocket.receive_text()
+            except WebSocketDisconnect:
+                eprint(f"Client disconnected: {start_message.name} link {link.link_id}")
+                break
+            link.last_seen = time.monotonic()
+            with STAGE_TIMERS.measure("edge_agents.validate"):
+                message = EdgeAgentToRelayMessage.model_validate_json(json_data)
+            eprint(f"Message received from client: {message}", only_debug=True)
+            if isinstance(message.inner, EtRPongMessage):
+                link.record_pong(message.inner)
+            elif isinstance(
+                message.inner,
+                (EtRInitiateConnectionErrorMessage, EtRInitiateConnectionOKMessage),
+            ):
+                eprint(f"Received initiate connection answer from client: {message}")
+                pending_link, answer = pending_initiations.get(
+                    message.inner.connection_id, (None, None)
+                )
+                if pending_link is not link or answer.done():
+                    eprint(f"Unexpected connection_id: {message.inner.connection_id}")
+                    continue
+                answer.set_result(message.inner)
+            elif isinstance(message.inner, EtRTCPDataMessage):
                 eprint(
-                    f"Unknown connection_id: {connection_reset_message.connection_id}"
+                    f"Received TCP data message from client: {message}", only_debug=True
                 )
-                continue
-            agent_connection, access_client_connection = active_connections[
-                connection_reset_message.connection_id
-            ]
-            await access_client_connection.send_text(
-                RelayToAccessClientMessage(
-                    inner=RtAErrorMessage(
-                        message=connection_reset_message.message,
+                tcp_data_message = message.inner
+                if tcp_data_message.connection_id not in active_connections:
+                    eprint(f"Unknown connection_id: {tcp_data_message.connection_id}")
+                    continue
+                _agent_connection, access_client_connection = active_connections[
+                    tcp_data_message.connection_id
+                ]
+                with STAGE_TIMERS.measure("edge_agents.forward_tcp_data"):
+                    await access_client_connection.send_text(
+                        RelayToAccessClientMessage(
+                            inner=RtATCPDataMessage(
+                                data_base64=tcp_data_message.data_base64,
+                            )
+                        ).model_dump_json()
                     )
-                ).model_dump_json()
-            )
-            del active_connections[connection_reset_message.connection_id]
-            # close the connection
-            await access_client_connection.close()
-        else:
-            eprint(f"Unknown message received from client: {message}")
+            elif isinstance(message.inner, EtRConnectionResetMessage):
+                eprint(f"Received connection reset message from client: {message}")
+                connection_reset_message = message.inner
+                if connection_reset_message.connection_id not in active_connections:
+                    eprint(
+                        "Unknown connection_id: "
+                        f"{connection_reset_message.connection_id}"
+                    )
+                    continue
+                agent_connection, access_client_connection = active_connections[
+                    connection_reset_message.connection_id
+                ]
+                await access_client_connection.send_text(
+                    RelayToAccessClientMessage(
+                        inner=RtAErrorMessage(
+                            message=connection_reset_message.message,
+                        )
+                    ).model_dump_json()
+                )
+                del active_connections[connection_reset_message.connection_id]
+                link.streams.discard(connection_reset_message.connection_id)
+                # close the connection
+                await access_client_connection.close()
+            else:
+                eprint(f"Unknown message received from client: {message}")
+    finally:
+        await unregister_link(link, "Edge agent disconnected")
 
 
 @app.websocket("/ws_for_access_clients")
@@ -153,19 +588,37 @@ async def ws_for_access_clients(websocket: WebSocket):
     json_data = await websocket.receive_text()
     message = AccessClientToRelayMessage.model_validate_json(json_data)
     eprint(f"Message received from access client: {message}")
-    if not isinstance(message.inner, AtRStartMessage):
+    if not isinstance(message.inner, (AtRStartMessage, AtRFanoutMessage)):
         eprint(f"Unknown message received from access client: {message}")
         return
     start_message = message.inner
     # check if credentials are correct
-    if start_message.secret not in CREDENTIALS["access-client-secrets"]:
-        eprint(f"Invalid access client secret: {start_message.secret}")
+    if not CREDENTIAL_STORE.verify_access_client(start_message.secret):
+        eprint("Invalid access client secret")
         # send a message back and kill the connection
         await websocket.send_text(
             RelayToAccessClientMessage(
                 inner=RtAErrorMessage(message="Invalid access client secret")
             ).model_dump_json()
         )
+        await websocket.close()
+        return
+    if draining and not starts_while_draining(start_message):
+        eprint(f"Draining, not starting {start_message.kind} for access client")
+        if drain_redirect_url is not None:
+            inner = RtARedirectMessage(
+                relay_url=drain_redirect_url.rstrip("/") + "/ws_for_access_clients"
+            )
+        else:
+            inner = RtAErrorMessage(message="Relay is draining")
+        await websocket.send_text(
+            RelayToAccessClientMessage(inner=inner).model_dump_json()
+        )
+        await websocket.close()
+        return
+    if isinstance(start_message, AtRFanoutMessage):
+        await fanout(websocket, start_message)
+        return
     # check if the client is registered
     if not start_message.connection_target in registered_agent_connections:
         eprint(f"Agent not registered: {start_message.connection_target}")
@@ -177,9 +630,7 @@ async def ws_for_access_clients(websocket: WebSocket):
         )
         await websocket.close()
         return
-    agent_connection = registered_agent_connections[start_message.connection_target]
     await start_connection(
-        agent_connection=agent_connection,
         access_client_connection=websocket,
         connection_target=start_message.connection_target,
         target_ip=start_message.target_ip,
@@ -188,11 +639,119 @@ async def ws_for_access_clients(websocket: WebSocket):
     )
 
 
+def starts_while_draining(start_message) -> bool:
+    """
+    Whether a draining relay still starts the access client's stream or
+    fan-out, which it does until the agents had time to migrate, as long
+    as the agents are linked to it.
+    """
+    if drain_redirect_url is None or time.monotonic() >= drain_migration_until:
+        return False
+    if isinstance(start_message, AtRFanoutMessage):
+        return True
+    return start_message.connection_target in registered_agent_connections
+
+
 active_connections = {}  # connection_id -> (agent_connection, access_client_connection)
 
 
+async def initiate_connection(
+    access_client_connection,
+    connection_target,
+    target_ip,
+    target_port,
+    protocol,
+    connection_id,
+    close_on_eof=False,
+) -> AgentLink:
+    """
+    Ask an agent to connect to the target and register the stream on the
+    link that answered. If a link is lost before the agent answered, the
+    next best link of the agent is tried.
+    """
+    tried_links = []
+    while True:
+        link = select_link(connection_target, exclude=tried_links)
+        if link is None:
+            raise InitiateConnectionError(
+                "Agent not registered" if not tried_links else "All links failed"
+            )
+        tried_links.append(link)
+        # registered before asking the agent, data may follow its answer directly
+        active_connections[connection_id] = (link.websocket, access_client_connection)
+        link.streams.add(connection_id)
+        answer = asyncio.get_running_loop().create_future()
+        pending_initiations[connection_id] = (link, answer)
+        try:
+            await link.websocket.send_text(
+                RelayToEdgeAgentMessage(
+                    inner=RtEInitiateConnectionMessage(
+                        target_ip=target_ip,
+                        target_port=target_port,
+                        protocol=protocol,
+                        connection_id=connection_id,
+                        close_on_eof=close_on_eof,
+                    )
+                ).model_dump_json()
+            )
+            # wait for the client to respond
+            message = await answer
+        except Exception as e:
+            eprint(f"Link {link.link_id} lost while starting {connection_id}: {e}")
+            link.streams.discard(connection_id)
+            active_connections.pop(connection_id, None)
+            continue
+        finally:
+            del pending_initiations[connection_id]
+        if isinstance(message, EtRInitiateConnectionErrorMessage):
+            eprint(f"Received error message from client: {message}")
+            link.streams.discard(connection_id)
+            active_connections.pop(connection_id, None)
+            raise InitiateConnectionError(message.message)
+        eprint(f"Received OK message from client: {message}")
+        return link
+
+
+class HeldConnection:
+    """
+    Takes the place of the access client's websocket in `active_connections`
+    until `start_ok` was sent, the agent may send data right after its OK
+    answer and the access client expects `start_ok` first.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        # messages for the access client, `None` if the stream was closed
+        self.held = []
+
+    async def send_text(self, data):
+        self.held.append(data)
+
+    async def close(self):
+        self.held.append(None)
+
+    async def release(self, connection_id):
+        """
+        Send the held messages and put the access client's websocket in
+        place. Returns `False` if the stream was closed meanwhile.
+        """
+        while self.held:
+            data = self.held.pop(0)
+            if data is None:
+                await self.connection.close()
+                return False
+            await self.connection.send_text(data)
+        # no await since the last check, nothing can be added in between
+        agent_connection, connection = active_connections.get(
+            connection_id, (None, None)
+        )
+        if connection is not self:
+            return False
+        active_connections[connection_id] = (agent_connection, self.connection)
+        return True
+
+
 async def start_connection(
-    agent_connection,
     access_client_connection,
     connection_target,
     target_ip,
@@ -203,70 +762,212 @@ async def start_connection(
     eprint(
         f"Starting connection to {target_ip}:{target_port} for {connection_target} using {protocol} with connection_id {connection_id}"
     )
-    active_connections[connection_id] = (agent_connection, access_client_connection)
-    await agent_connection.send_text(
-        RelayToEdgeAgentMessage(
-            inner=RtEInitiateConnectionMessage(
-                target_ip=target_ip,
-                target_port=target_port,
-                protocol=protocol,
-                connection_id=connection_id,
-            )
-        ).model_dump_json()
-    )
-    # wait for the client to respond
-    message = await initiate_connection_answer_queue.get()
-    if not isinstance(
-        message, (EtRInitiateConnectionErrorMessage, EtRInitiateConnectionOKMessage)
-    ):
-        raise ValueError(f"Unexpected message: {message}")
-    if message.connection_id != connection_id:
-        raise ValueError(f"Unexpected connection_id: {message.connection_id}")
-    if isinstance(message, EtRInitiateConnectionErrorMessage):
-        eprint(f"Received error message from client: {message}")
+    held_connection = HeldConnection(access_client_connection)
+    try:
+        link = await initiate_connection(
+            access_client_connection=held_connection,
+            connection_target=connection_target,
+            target_ip=target_ip,
+            target_port=target_port,
+            protocol=protocol,
+            connection_id=connection_id,
+        )
+    except InitiateConnectionError as e:
         await access_client_connection.send_text(
             RelayToAccessClientMessage(
-                inner=RtAErrorMessage(
-                    message=f"Initiating connection failed: {message.message}"
-                )
+                inner=RtAErrorMessage(message=f"Initiating connection failed: {e}")
             ).model_dump_json()
         )
         # close the connection
         await access_client_connection.close()
-        del active_connections[connection_id]
         return
-    if isinstance(message, EtRInitiateConnectionOKMessage):
-        eprint(f"Received OK message from client: {message}")
     await access_client_connection.send_text(
         RelayToAccessClientMessage(inner=RtAStartOKMessage()).model_dump_json()
     )
+    if not await held_connection.release(connection_id):
+        # reset by the agent or its link was lost before `start_ok` was sent
+        return
 
     while True:
         try:
             json_data = await access_client_connection.receive_text()
         except WebSocketDisconnect:
             eprint(f"access client disconnected: {connection_id}")
-            if connection_id in active_connections:
-                del active_connections[connection_id]
+            await reset_stream(
+                connection_id, connection_target, "Access client disconnected"
+            )
             break
-        message = AccessClientToRelayMessage.model_validate_json(json_data)
+        if connection_id not in active_connections:
+            # reset by the agent or its link was lost
+            continue
+        with STAGE_TIMERS.measure("access_clients.validate"):
+            message = AccessClientToRelayMessage.model_validate_json(json_data)
         if isinstance(message.inner, AtRTCPDataMessage):
             eprint(
                 f"Received TCP data message from access client: {message}",
                 only_debug=True,
             )
-            await agent_connection.send_text(
-                RelayToEdgeAgentMessage(
-                    inner=RtETCPDataMessage(
-                        connection_id=connection_id,
-                        data_base64=message.inner.data_base64,
-                    )
-                ).model_dump_json()
-            )
+            with STAGE_TIMERS.measure("access_clients.forward_tcp_data"):
+                await link.websocket.send_text(
+                    RelayToEdgeAgentMessage(
+                        inner=RtETCPDataMessage(
+                            connection_id=connection_id,
+                            data_base64=message.inner.data_base64,
+                        )
+                    ).model_dump_json()
+                )
         else:
             eprint(f"Unknown message received from access client: {message}")
 
 
+class FanoutStream:
+    """
+    Takes the place of the access client's websocket in `active_connections`
+    for one target of a fan-out, the data is labeled with the agent's name
+    and sent on the fan-out's websocket.
+    """
+
+    def __init__(self, agent, send):
+        self.agent = agent
+        self.send = send
+        self.received = 0
+        # why the stream ended
+        self.reason = None
+        # set if the fan-out's websocket failed, which ends the fan-out
+        self.send_error = None
+        self.closed = asyncio.Event()
+
+    async def send_text(self, json_data):
+        message = decode_message(json_data)
+        if message["kind"] == "tcp_data":
+            data_base64 = message["data_base64"]
+            self.received += len(data_base64) * 3 // 4 - data_base64[-2:].count("=")
+            try:
+                await self.send(
+                    RtAFanoutDataMessage(agent=self.agent, data_base64=data_base64)
+                )
+            except Exception as e:
+                # raised again by `fanout_to_agent`, not in the agent's link
+                self.send_error = e
+                self.closed.set()
+        elif message["kind"] == "error":
+            self.reason = message["message"]
+
+    async def close(self):
+        self.closed.set()
+
+
+async def fanout(websocket, fanout_message: AtRFanoutMessage):
+    """
+    Connect to the target on every agent matching the selector, send the
+    payload and stream the labeled answers back: `fanout_start` with the
+    agents, `fanout_data` as data arrives, one `fanout_result` per agent
+    once its target closed the connection or timed out, and `fanout_done`.
+    Closes the websocket unless the access client is gone.
+    """
+    if not 0 < fanout_message.parallelism <= MAX_FANOUT_PARALLELISM:
+        error = f"parallelism must be between 1 and {MAX_FANOUT_PARALLELISM}"
+    elif not fanout_message.timeout > 0:
+        error = "timeout must be positive"
+    else:
+        error = None
+    if error is not None:
+        await websocket.send_text(
+            RelayToAccessClientMessage(inner=RtAErrorMessage(message=error)).model_dump_json()
+        )
+        await websocket.close()
+        return
+
+    agents = sorted(
+        name
+        for name in registered_agent_connections
+        if fnmatchcase(name, fanout_message.selector)
+    )
+    eprint(f"Fan-out to {len(agents)} agents matching {fanout_message.selector}")
+    # the streams answer concurrently, one message is sent at a time
+    send_lock = asyncio.Lock()
+
+    async def send(inner):
+        async with send_lock:
+            await websocket.send_text(
+                RelayToAccessClientMessage(inner=inner).model_dump_json()
+            )
+
+    await send(RtAFanoutStartMessage(agents=agents))
+    parallelism = asyncio.Semaphore(fanout_message.parallelism)
+    try:
+        async with asyncio.TaskGroup() as task_group:
+            tasks = [
+                task_group.create_task(
+                    fanout_to_agent(agent, fanout_message, parallelism, send)
+                )
+                for agent in agents
+            ]
+    except ExceptionGroup as e:
+        # the access client is gone, the streams were reset by `fanout_to_agent`
+        eprint(f"Fan-out aborted: {e.exceptions}")
+        return
+    ok = sum(task.result() for task in tasks)
+    await send(RtAFanoutDoneMessage(ok=ok, failed=len(agents) - ok))
+    await websocket.close()
+
+
+async def fanout_to_agent(agent, fanout_message: AtRFanoutMessage, parallelism, send):
+    async with parallelism:
+        connection_id = str(uuid.uuid4())
+        stream = FanoutStream(agent, send)
+        started = time.monotonic()
+        status, reason = "ok", None
+        try:
+            async with asyncio.timeout(fanout_message.timeout):
+                link = await initiate_connection(
+                    access_client_connection=stream,
+                    connection_target=agent,
+                    target_ip=fanout_message.target_ip,
+                    target_port=fanout_message.target_port,
+                    protocol=fanout_message.protocol,
+                    connection_id=connection_id,
+                    # the target is done when it sent EOF
+                    close_on_eof=True,
+                )
+                if fanout_message.data_base64:
+                    await link.websocket.send_text(
+                        RelayToEdgeAgentMessage(
+                            inner=RtETCPDataMessage(
+                                connection_id=connection_id,
+                                data_base64=fanout_message.data_base64,
+                            )
+                        ).model_dump_json()
+                    )
+                await stream.closed.wait()
+            if stream.reason != CONNECTION_CLOSED_BY_TARGET:
+                status, reason = "error", stream.reason
+        except TimeoutError:
+            status = "timeout"
+            reason = f"Target did not close within {fanout_message.timeout} seconds"
+        except InitiateConnectionError as e:
+            status, reason = "error", f"Initiating connection failed: {e}"
+        except Exception as e:
+            # the agent's link failed, only `send` failing aborts the fan-out
+            eprint(f"Fan-out to {agent} failed: {e}")
+            status, reason = "error", f"Sending to the agent failed: {e}"
+        finally:
+            # also when the fan-out is cancelled
+            await reset_stream(connection_id, agent, f"Fan-out {status}")
+        if stream.send_error is not None:
+            raise stream.send_error
+        await send(
+            RtAFanoutResultMessage(
+                agent=agent,
+                status=status,
+                message=reason,
+                received=stream.received,
+                duration=round(time.monotonic() - started, 6),
+            )
+        )
+        return status == "ok"
+
+
 parser = argparse.ArgumentParser(description="Run the HTTP network relay server")
 parser.add_argument(
     "--host",
@@ -281,9 +982,70 @@ parser.add_argument(
 )
 parser.add_argument(
     "--credentials-file",
-    help="The credentials file",
+    help="The credentials file, a JSON file or an SQLite database",
     default=CREDENTIALS_FILE,
 )
+parser.add_argument(
+    "--server",
+    help="The server implementation, `lean` serves the WebSocket routes "
+    "directly with `websockets` instead of FastAPI and uvicorn",
+    choices=["fastapi", "lean"],
+    default=os.getenv("HTTP_NETWORK_RELAY_SERVER_IMPLEMENTATION", "fastapi"),
+)
+parser.add_argument(
+    "--heartbeat-interval",
+    help="Seconds between pings sent to each edge agent",
+    type=float,
+    default=HEARTBEAT_INTERVAL,
+)
+parser.add_argument(
+    "--heartbeat-timeout",
+    help="Seconds without any message after which an edge agent is evicted",
+    type=float,
+    default=HEARTBEAT_TIMEOUT,
+)
+parser.add_argument(
+    "--max-links-per-agent",
+    help="How many WebSocket links one edge agent may open at the same time",
+    type=int,
+    default=MAX_LINKS_PER_AGENT,
+)
+parser.add_argument(
+    "--max-message-size",
+    help="Largest WebSocket message accepted, in bytes",
+    type=int,
+    default=MAX_MESSAGE_SIZE,
+)
+parser.add_argument(
+    "--max-fanout-parallelism",
+    help="Highest parallelism a fan-out may ask for",
+    type=int,
+    default=MAX_FANOUT_PARALLELISM,
+)
+parser.add_argument(
+    "--drain-redirect-url",
+    help="Base URL of the relay that takes over when this one is drained "
+    "with SIGUSR2, e.g. `wss://relay-2.example.com`",
+    default=DRAIN_REDIRECT_URL,
+)
+parser.add_argument(
+    "--drain-spread",
+    help="Seconds over which agents are moved or reconnected when draining",
+    type=float,
+    default=DRAIN_SPREAD,
+)
+parser.add_argument(
+    "--drain-timeout",
+    help="Seconds to wait for streams to finish when draining",
+    type=float,
+    default=DRAIN_TIMEOUT,
+)
+parser.add_argument(
+    "--credentials-backend",
+    help="The credentials backend, guessed from the file extension if not set",
+    choices=["json", "sqlite"],
+    default=CREDENTIALS_BACKEND,
+)
 
 
 def main():
@@ -291,16 +1053,56 @@ def main():
     global CREDENTIALS_FILE
     CREDENTIALS_FILE = args.credentials_file
 
-    with open(CREDENTIALS_FILE) as f:
-        global CREDENTIALS
-        CREDENTIALS = json.load(f)
+    global HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, MAX_LINKS_PER_AGENT
+    HEARTBEAT_INTERVAL = args.heartbeat_interval
+    HEARTBEAT_TIMEOUT = args.heartbeat_timeout
+    MAX_LINKS_PER_AGENT = args.max_links_per_agent
+
+    global MAX_FANOUT_PARALLELISM
+    MAX_FANOUT_PARALLELISM = args.max_fanout_parallelism
 
-    uvicorn.run(
-        app,
-        host=args.host,
-        port=args.port,
-        log_level="info",
+    global MAX_MESSAGE_SIZE
+    MAX_MESSAGE_SIZE = args.max_message_size
+
+    global DRAIN_REDIRECT_URL, DRAIN_SPREAD, DRAIN_TIMEOUT
+    DRAIN_REDIRECT_URL = args.drain_redirect_url
+    DRAIN_SPREAD = args.drain_spread
+    DRAIN_TIMEOUT = args.drain_timeout
+
+    global CREDENTIAL_STORE
+    CREDENTIAL_STORE = open_credential_store(
+        CREDENTIALS_FILE, backend=args.credentials_backend
+    )
+
+    if args.server == "lean":
+        from . import lean_server
+
+        lean_server.run(
+            {
+                "/ws_for_edge_agents": ws_for_edge_agents,
+                "/ws_for_access_clients": ws_for_access_clients,
+            },
+            http_routes={"/agents": get_agents, "/admin/profile": get_admin_profile},
+            host=args.host,
+            port=args.port,
+            lifespan=lifespan,
+            shutdown_event=shutdown_event,
+            max_size=MAX_MESSAGE_SIZE,
+        )
+        return
+
+    # a `Server` instead of `uvicorn.run` so a finished drain can stop it
+    global uvicorn_server
+    uvicorn_server = uvicorn.Server(
+        uvicorn.Config(
+            app,
+            host=args.host,
+            port=args.port,
+            log_level="info",
+            ws_max_size=MAX_MESSAGE_SIZE,
+        )
     )
+    uvicorn_server.run()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,224 @@
+import asyncio
+import cProfile
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import nullcontext
+
+PROFILE_KINDS = ["cpu", "cprofile", "memory", "loop-lag", "stages"]
+MAX_PROFILE_DURATION = 300
+
+debug = False
+if os.getenv("DEBUG") == "1":
+    debug = True
+
+
+def eprint(*args, only_debug=False, **kwargs):
+    if (debug and only_debug) or (not only_debug):
+        print(*args, file=sys.stderr, **kwargs)
+
+
+class ProfilingBusyError(Exception):
+    pass
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread from a background thread.
+
+    The result is in the collapsed stack format ("outer;inner count" per
+    line), which flamegraph.pl, speedscope and most flame graph viewers read.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> bytes:
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+        ).encode()
+
+
+class EventLoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a task that sleeps for
+    `interval` seconds, lag means callbacks are blocking the loop.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+
+    async def run(self, duration):
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.monotonic() - started - self.interval))
+
+    def report(self):
+        lags = sorted(self.lags)
+
+        def ms(seconds):
+            return round(seconds * 1000, 3)
+
+        return {
+            "interval_ms": ms(self.interval),
+            "samples": len(lags),
+            "mean_lag_ms": ms(sum(lags) / len(lags)) if lags else None,
+            "p99_lag_ms": ms(lags[int(len(lags) * 0.99)]) if lags else None,
+            "max_lag_ms": ms(lags[-1]) if lags else None,
+        }
+
+
+class _StageTimer:
+    def __init__(self, timers, stage):
+        self.timers = timers
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timers.record(self.stage, time.perf_counter() - self.started)
+
+
+class StageTimers:
+    """
+    Time spent per named stage of a hot loop, only measured while enabled.
+
+        with STAGE_TIMERS.measure("edge_agent.validate"):
+            ...
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}  # stage -> [count, total seconds, max seconds]
+
+    def measure(self, stage):
+        if not self.enabled:
+            return nullcontext()
+        return _StageTimer(self, stage)
+
+    def record(self, stage, elapsed):
+        stats = self.stages.get(stage)
+        if stats is None:
+            self.stages[stage] = [1, elapsed, elapsed]
+            return
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+    def report(self):
+        return {
+            stage: {
+                "count": count,
+                "total_ms": round(total * 1000, 3),
+                "mean_us": round(total / count * 1e6, 3),
+                "max_us": round(maximum * 1e6, 3),
+            }
+            for stage, (count, total, maximum) in sorted(self.stages.items())
+        }
+
+
+STAGE_TIMERS = StageTimers()
+
+active_profile_kinds = set()
+
+
+async def profile(kind, duration):
+    """
+    Profile the running event loop for `duration` seconds.
+
+    Returns the file name and content of the result: collapsed stacks for
+    `cpu`, a pstats file for `cprofile` (deterministic, higher overhead), a
+    `tracemalloc.Snapshot` dump for `memory` and JSON for `loop-lag` and
+    `stages`. Only one profile of each kind runs at a time.
+    """
+    if kind not in PROFILE_KINDS:
+        raise ValueError(f"Unknown profile kind: {kind}")
+    if not 0 < duration <= MAX_PROFILE_DURATION:
+        raise ValueError(
+            f"Duration must be between 0 and {MAX_PROFILE_DURATION} seconds"
+        )
+    if kind in active_profile_kinds:
+        raise ProfilingBusyError(f"A {kind} profile is already running")
+    active_profile_kinds.add(kind)
+    eprint(f"Starting {kind} profile for {duration} seconds")
+    try:
+        if kind == "cpu":
+            profiler = SamplingProfiler(threading.get_ident())
+            profiler.start()
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                profiler.stop()
+            return "profile.folded", profiler.collapsed()
+        if kind == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                profiler.disable()
+            return "profile.pstats", _dump_to_bytes(profiler.dump_stats)
+        if kind == "memory":
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start(25)
+            try:
+                await asyncio.sleep(duration)
+                snapshot = tracemalloc.take_snapshot()
+            finally:
+                if started_tracing:
+                    tracemalloc.stop()
+            return "memory.tracemalloc", _dump_to_bytes(snapshot.dump)
+        if kind == "loop-lag":
+            monitor = EventLoopLagMonitor()
+            await monitor.run(duration)
+            return "loop-lag.json", json.dumps(monitor.report()).encode()
+        STAGE_TIMERS.stages = {}
+        STAGE_TIMERS.enabled = True
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            STAGE_TIMERS.enabled = False
+        return "stages.json", json.dumps(STAGE_TIMERS.report()).encode()
+    finally:
+        active_profile_kinds.discard(kind)
+        eprint(f"Finished {kind} profile")
+
+
+def _dump_to_bytes(dump):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "dump")
+        dump(path)
+        with open(path, "rb") as f:
+            return f.read()
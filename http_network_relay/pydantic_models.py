@@ -10,6 +10,7 @@ class EdgeAgentToRelayMessage(BaseModel):
         "EtRInitiateConnectionOKMessage",
         "EtRTCPDataMessage",
         "EtRConnectionResetMessage",
+        "EtRPongMessage",
     ] = Field(discriminator="kind")
 
 
@@ -42,10 +43,20 @@ class EtRConnectionResetMessage(BaseModel):
     connection_id: str
 
 
+class EtRPongMessage(BaseModel):
+    kind: Literal["pong"] = "pong"
+    ping_id: int
+    sent_at: float
+
+
 class RelayToEdgeAgentMessage(BaseModel):
-    inner: Union["RtEInitiateConnectionMessage", "RtETCPDataMessage"] = Field(
-        discriminator="kind"
-    )
+    inner: Union[
+        "RtEInitiateConnectionMessage",
+        "RtETCPDataMessage",
+        "RtEPingMessage",
+        "RtEMigrateMessage",
+        "RtEConnectionResetMessage",
+    ] = Field(discriminator="kind")
 
 
 class RtEInitiateConnectionMessage(BaseModel):
@@ -54,6 +65,9 @@ class RtEInitiateConnectionMessage(BaseModel):
     target_port: int
     protocol: str
     connection_id: str
+    # close the connection once the target sent EOF instead of keeping it
+    # half-open, used by fan-outs to learn when a target is done
+    close_on_eof: bool = False
 
 
 class RtETCPDataMessage(BaseModel):
@@ -62,8 +76,32 @@ class RtETCPDataMessage(BaseModel):
     data_base64: str
 
 
+class RtEPingMessage(BaseModel):
+    kind: Literal["ping"] = "ping"
+    ping_id: int
+    # relay clock, echoed back in the pong
+    sent_at: float
+
+
+class RtEMigrateMessage(BaseModel):
+    kind: Literal["migrate"] = "migrate"
+    # where to open new links, `None` to reconnect as usual once the
+    # relay closes the current links
+    relay_url: Union[str, None] = None
+    # open the new links at a random time within this many seconds
+    spread: float = 0
+
+
+class RtEConnectionResetMessage(BaseModel):
+    kind: Literal["connection_reset"] = "connection_reset"
+    message: str
+    connection_id: str
+
+
 class AccessClientToRelayMessage(BaseModel):
-    inner: Union["AtRStartMessage", "AtRTCPDataMessage"] = Field(discriminator="kind")
+    inner: Union["AtRStartMessage", "AtRTCPDataMessage", "AtRFanoutMessage"] = Field(
+        discriminator="kind"
+    )
 
 
 class AtRStartMessage(BaseModel):
@@ -80,10 +118,33 @@ class AtRTCPDataMessage(BaseModel):
     data_base64: str
 
 
+class AtRFanoutMessage(BaseModel):
+    kind: Literal["fanout"] = "fanout"
+    # `fnmatch` pattern of the agent names, e.g. `sensor-*`
+    selector: str
+    target_ip: str
+    target_port: int
+    protocol: str
+    secret: str
+    # sent to every target once connected
+    data_base64: str = ""
+    # targets connected at the same time
+    parallelism: int = 32
+    # seconds per target, from starting the connection to the target closing it
+    timeout: float = 10
+
+
 class RelayToAccessClientMessage(BaseModel):
-    inner: Union["RtAErrorMessage", "RtAStartOKMessage", "RtATCPDataMessage"] = Field(
-        discriminator="kind"
-    )
+    inner: Union[
+        "RtAErrorMessage",
+        "RtAStartOKMessage",
+        "RtATCPDataMessage",
+        "RtARedirectMessage",
+        "RtAFanoutStartMessage",
+        "RtAFanoutDataMessage",
+        "RtAFanoutResultMessage",
+        "RtAFanoutDoneMessage",
+    ] = Field(discriminator="kind")
 
 
 class RtAErrorMessage(BaseModel):
@@ -100,5 +161,38 @@ class RtATCPDataMessage(BaseModel):
     data_base64: str
 
 
+class RtARedirectMessage(BaseModel):
+    kind: Literal["redirect"] = "redirect"
+    relay_url: str
+
+
+class RtAFanoutStartMessage(BaseModel):
+    kind: Literal["fanout_start"] = "fanout_start"
+    # the agents matching the selector
+    agents: list[str]
+
+
+class RtAFanoutDataMessage(BaseModel):
+    kind: Literal["fanout_data"] = "fanout_data"
+    agent: str
+    data_base64: str
+
+
+class RtAFanoutResultMessage(BaseModel):
+    kind: Literal["fanout_result"] = "fanout_result"
+    agent: str
+    status: Literal["ok", "error", "timeout"]
+    message: Union[str, None] = None
+    # bytes received from the target
+    received: int
+    duration: float
+
+
+class RtAFanoutDoneMessage(BaseModel):
+    kind: Literal["fanout_done"] = "fanout_done"
+    ok: int
+    failed: int
+
+
 def main():
     pass
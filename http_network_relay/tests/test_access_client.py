@@ -0,0 +1,117 @@
+import asyncio
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from websockets.asyncio.server import serve
+
+from http_network_relay import access_client
+
+
+def test_write_stdout_to_slow_pipe_keeps_order(monkeypatch):
+    read_fd, write_fd = os.pipe()
+    chunks = [bytes([i]) * 16 * 1024 for i in range(200)]
+    received = bytearray()
+
+    def slow_reader():
+        with os.fdopen(read_fd, "rb", buffering=0) as pipe:
+            while True:
+                data = pipe.read(64 * 1024)
+                if not data:
+                    return
+                received.extend(data)
+                time.sleep(0.001)
+
+    reader_thread = threading.Thread(target=slow_reader)
+    reader_thread.start()
+    stdout = os.fdopen(write_fd, "w")
+    monkeypatch.setattr(sys, "stdout", stdout)
+    # shares the file status flags with stdout, which is closed with the
+    # pipe transport, like the descriptor a parent process keeps
+    inherited_fd = os.dup(write_fd)
+
+    async def scenario():
+        queue = asyncio.Queue(maxsize=4)
+        write_stdout_task = asyncio.create_task(access_client.write_stdout(queue))
+        waited = 0
+        for chunk in chunks:
+            if queue.full():
+                waited += 1
+            assert await access_client.queue_for_stdout(
+                queue, write_stdout_task, chunk
+            )
+        assert await access_client.queue_for_stdout(queue, write_stdout_task, None)
+        await write_stdout_task
+        return waited
+
+    try:
+        # stdout is slower than the producer, which had to wait for room
+        assert asyncio.run(scenario()) > 0
+        assert os.get_blocking(inherited_fd)
+    finally:
+        stdout.close()
+        os.close(inherited_fd)
+        reader_thread.join()
+    assert bytes(received) == b"".join(chunks)
+
+
+def test_session_handles_data_before_start_ok(monkeypatch):
+    # a relay that forwards the target's banner before `start_ok`
+    stdin_reader = None
+
+    def data_message(data):
+        data_base64 = base64.b64encode(data).decode()
+        return json.dumps({"inner": {"kind": "tcp_data", "data_base64": data_base64}})
+
+    sent_to_target = []
+
+    async def relay(websocket):
+        await websocket.recv()
+        await websocket.send(data_message(b"banner\n"))
+        await websocket.send(json.dumps({"inner": {"kind": "start_ok"}}))
+        async for message in websocket:
+            inner = json.loads(message)["inner"]
+            sent_to_target.append(base64.b64decode(inner["data_base64"]))
+            if sent_to_target == [b"one"]:
+                stdin_reader.feed_data(b"two")
+            elif b"".join(sent_to_target) == b"onetwo":
+                break
+        await websocket.send(data_message(b"bye\n"))
+
+    async def scenario(relay_url):
+        unacknowledged_chunks = []
+        stdin_reader.feed_data(b"one")
+        args = SimpleNamespace(
+            target_host_identifier="agent",
+            target_ip="127.0.0.1",
+            target_port=22,
+            protocol="tcp",
+            secret="secret",
+        )
+        assert (
+            await access_client.run_session(
+                args, relay_url, stdin_reader, unacknowledged_chunks
+            )
+            is None
+        )
+        return unacknowledged_chunks
+
+    async def main():
+        nonlocal stdin_reader
+        stdin_reader = asyncio.StreamReader()
+        async with serve(relay, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            return await scenario(f"ws://127.0.0.1:{port}")
+
+    with tempfile.TemporaryFile() as stdout_file:
+        stdout = os.fdopen(os.dup(stdout_file.fileno()), "w")
+        monkeypatch.setattr(sys, "stdout", stdout)
+        assert asyncio.run(main()) == []
+        stdout_file.seek(0)
+        assert stdout_file.read() == b"banner\nbye\n"
+    assert b"".join(sent_to_target) == b"onetwo"
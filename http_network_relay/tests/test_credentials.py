@@ -0,0 +1,79 @@
+import json
+import os
+
+import pytest
+
+from http_network_relay.credentials import (
+    CredentialStore,
+    JSONFileCredentialStore,
+    SQLiteCredentialStore,
+    open_credential_store,
+)
+
+
+def write_credentials(path, edge_agents, access_client_secrets):
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "edge-agents": edge_agents,
+                "access-client-secrets": access_client_secrets,
+            },
+            f,
+        )
+
+
+def test_json_store_reloads_on_change(tmp_path):
+    path = str(tmp_path / "credentials.json")
+    write_credentials(path, {"agent": "old"}, ["client-old"])
+    store = JSONFileCredentialStore(path, reload_interval=0)
+    assert store.verify_edge_agent("agent", "old")
+    assert not store.verify_edge_agent("agent", "new")
+    assert not store.verify_edge_agent("other", "old")
+    assert store.verify_access_client("client-old")
+
+    write_credentials(path, {"agent": "new"}, ["client-new"])
+    os.utime(path, ns=(0, 0))
+    assert store.verify_edge_agent("agent", "new")
+    assert not store.verify_edge_agent("agent", "old")
+    assert store.verify_access_client("client-new")
+    assert not store.verify_access_client("client-old")
+
+
+def test_json_store_keeps_credentials_on_broken_file(tmp_path):
+    path = str(tmp_path / "credentials.json")
+    write_credentials(path, {"agent": "secret"}, [])
+    store = JSONFileCredentialStore(path, reload_interval=0)
+    with open(path, "w") as f:
+        f.write("{")
+    assert store.verify_edge_agent("agent", "secret")
+
+
+def test_sqlite_store_picks_up_external_changes(tmp_path):
+    path = str(tmp_path / "credentials.db")
+    store = open_credential_store(path)
+    assert isinstance(store, SQLiteCredentialStore)
+    assert not store.verify_edge_agent("agent", "secret")
+
+    admin = SQLiteCredentialStore(path)
+    admin.set_edge_agent("agent", "secret")
+    admin.add_access_client_secret("client")
+    assert store.verify_edge_agent("agent", "secret")
+    assert store.verify_access_client("client")
+
+    admin.set_edge_agent("agent", "rotated")
+    assert not store.verify_edge_agent("agent", "secret")
+    assert store.verify_edge_agent("agent", "rotated")
+    admin.close()
+    store.close()
+
+
+def test_store_without_all_hooks_cannot_be_created():
+    class IncompleteStore(CredentialStore):
+        def _refresh(self):
+            return False
+
+        def _edge_agent_digest(self, name):
+            return None
+
+    with pytest.raises(TypeError):
+        IncompleteStore()
@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import base64
+
+import pytest
+from websockets.asyncio.server import serve
+
+from http_network_relay import edge_agent
+from http_network_relay.pydantic_models import (
+    EdgeAgentToRelayMessage,
+    EtRConnectionResetMessage,
+    EtRInitiateConnectionOKMessage,
+    EtRPongMessage,
+    EtRTCPDataMessage,
+    RelayToEdgeAgentMessage,
+    RtEInitiateConnectionMessage,
+    RtEPingMessage,
+    RtETCPDataMessage,
+)
+from http_network_relay.wire_format import CONNECTION_CLOSED_BY_TARGET, decode_message
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.sent_event = asyncio.Event()
+
+    async def send(self, message, text=None):
+        self.sent.append(message)
+        self.sent_event.set()
+
+    async def wait_for_messages(self, count):
+        while len(self.sent) < count:
+            self.sent_event.clear()
+            await self.sent_event.wait()
+
+
+@pytest.fixture(autouse=True)
+def clean_agent_state():
+    yield
+    edge_agent.active_connections.clear()
+
+
+def test_target_connection_forwards_data_both_ways(monkeypatch):
+    # a small buffer, so the data arrives in several chunks
+    monkeypatch.setattr(edge_agent, "TARGET_READ_SIZE", 1000)
+    data = bytes(range(256)) * 100
+
+    async def scenario():
+        written_to_target = asyncio.get_running_loop().create_future()
+
+        async def target(reader, writer):
+            writer.write(data)
+            await writer.drain()
+            written_to_target.set_result(await reader.readexactly(5))
+            writer.close()
+
+        server = await asyncio.start_server(target, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        websocket = FakeWebSocket()
+        await edge_agent.initiate_connection(
+            RtEInitiateConnectionMessage(
+                target_ip="127.0.0.1",
+                target_port=port,
+                protocol="tcp",
+                connection_id="connection",
+                close_on_eof=True,
+            ),
+            websocket,
+        )
+        received = b""
+        while len(received) < len(data):
+            await websocket.wait_for_messages(len(websocket.sent) + 1)
+            message = EdgeAgentToRelayMessage.model_validate_json(websocket.sent[-1])
+            assert isinstance(message.inner, EtRTCPDataMessage)
+            assert message.inner.connection_id == "connection"
+            assert len(message.inner.data_base64) <= 4 * 1000 / 3 + 4
+            received += base64.b64decode(message.inner.data_base64)
+        assert EdgeAgentToRelayMessage.model_validate_json(
+            websocket.sent[0]
+        ).inner == EtRInitiateConnectionOKMessage(connection_id="connection")
+        assert received == data
+
+        await edge_agent.write_to_target(
+            decode_message(
+                RelayToEdgeAgentMessage(
+                    inner=RtETCPDataMessage(
+                        connection_id="connection", data_base64="aGVsbG8="
+                    )
+                ).model_dump_json()
+            ),
+            websocket,
+            set(),
+        )
+        assert await written_to_target == b"hello"
+
+        # the target closed the connection, the agent closes its side too
+        await websocket.wait_for_messages(len(websocket.sent) + 1)
+        assert EdgeAgentToRelayMessage.model_validate_json(
+            websocket.sent[-1]
+        ).inner == EtRConnectionResetMessage(
+            message=CONNECTION_CLOSED_BY_TARGET, connection_id="connection"
+        )
+        assert edge_agent.active_connections == {}
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_half_closed_target_stays_writable():
+    async def scenario():
+        written_to_target = asyncio.get_running_loop().create_future()
+
+        async def target(reader, writer):
+            writer.write(b"hi")
+            # shutdown(SHUT_WR), the target still reads
+            writer.write_eof()
+            written_to_target.set_result(await reader.readexactly(5))
+            writer.close()
+
+        server = await asyncio.start_server(target, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        websocket = FakeWebSocket()
+        await edge_agent.initiate_connection(
+            RtEInitiateConnectionMessage(
+                target_ip="127.0.0.1",
+                target_port=port,
+                protocol="tcp",
+                connection_id="connection",
+            ),
+            websocket,
+        )
+        await websocket.wait_for_messages(2)
+        # give the agent time to see the EOF
+        await asyncio.sleep(0.05)
+        await edge_agent.write_to_target(
+            decode_message(
+                RelayToEdgeAgentMessage(
+                    inner=RtETCPDataMessage(
+                        connection_id="connection", data_base64="aGVsbG8="
+                    )
+                ).model_dump_json()
+            ),
+            websocket,
+            set(),
+        )
+        assert await written_to_target == b"hello"
+        messages = [
+            EdgeAgentToRelayMessage.model_validate_json(message).inner
+            for message in websocket.sent
+        ]
+        assert messages == [
+            EtRInitiateConnectionOKMessage(connection_id="connection"),
+            EtRTCPDataMessage(connection_id="connection", data_base64="aGk="),
+        ]
+        edge_agent.active_connections["connection"].transport.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_link_answers_pings_while_a_target_connects(monkeypatch):
+    async def scenario():
+        connecting = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def initiate_connection(message, websocket):
+            connecting.set()
+            try:
+                # a target that never answers
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        monkeypatch.setattr(edge_agent, "initiate_connection", initiate_connection)
+
+        async def relay(websocket):
+            await websocket.recv()
+            await websocket.send(
+                RelayToEdgeAgentMessage(
+                    inner=RtEInitiateConnectionMessage(
+                        target_ip="192.0.2.1",
+                        target_port=22,
+                        protocol="tcp",
+                        connection_id="connection",
+                    )
+                ).model_dump_json()
+            )
+            await connecting.wait()
+            await websocket.send(
+                RelayToEdgeAgentMessage(
+                    inner=RtEPingMessage(ping_id=0, sent_at=1.0)
+                ).model_dump_json()
+            )
+            assert EdgeAgentToRelayMessage.model_validate_json(
+                await websocket.recv()
+            ).inner == EtRPongMessage(ping_id=0, sent_at=1.0)
+
+        async with serve(relay, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            await asyncio.wait_for(
+                edge_agent.connect_to_server(
+                    argparse.Namespace(name="agent", secret="secret"),
+                    f"ws://127.0.0.1:{port}",
+                ),
+                timeout=1,
+            )
+        # the link closed, its pending connection attempt is given up
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+
+    asyncio.run(scenario())
+
+
+def test_target_that_does_not_read_is_reset(monkeypatch):
+    monkeypatch.setattr(edge_agent, "TARGET_MAX_WRITE_BUFFER", 1024)
+
+    async def scenario():
+        target_closed = asyncio.Event()
+
+        async def target(reader, writer):
+            await target_closed.wait()
+            writer.close()
+
+        server = await asyncio.start_server(target, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        websocket = FakeWebSocket()
+        await edge_agent.initiate_connection(
+            RtEInitiateConnectionMessage(
+                target_ip="127.0.0.1",
+                target_port=port,
+                protocol="tcp",
+                connection_id="connection",
+            ),
+            websocket,
+        )
+        # more than the socket buffers take, the rest waits in the transport
+        await edge_agent.write_to_target(
+            {
+                "connection_id": "connection",
+                "data_base64": base64.b64encode(bytes(16 * 1024 * 1024)).decode(),
+            },
+            websocket,
+            set(),
+        )
+        await websocket.wait_for_messages(2)
+        assert EdgeAgentToRelayMessage.model_validate_json(
+            websocket.sent[-1]
+        ).inner == EtRConnectionResetMessage(
+            message="Target is not reading the data sent to it",
+            connection_id="connection",
+        )
+        assert edge_agent.active_connections == {}
+        target_closed.set()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(scenario())
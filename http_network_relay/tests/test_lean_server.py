@@ -0,0 +1,85 @@
+import asyncio
+import json
+import selectors
+import socket
+
+from http_network_relay import lean_server, network_relay
+
+
+SPEEDUP = 100
+
+
+class FastSelector(selectors.DefaultSelector):
+    def select(self, timeout=None):
+        return super().select(None if timeout is None else timeout / SPEEDUP)
+
+
+class FastClockEventLoop(asyncio.SelectorEventLoop):
+    """
+    An event loop whose clock runs `SPEEDUP` times faster, so timeouts and
+    sleeps of several seconds take a few milliseconds.
+    """
+
+    def __init__(self):
+        super().__init__(FastSelector())
+
+    def time(self):
+        return super().time() * SPEEDUP
+
+
+class AllowAllCredentialStore:
+    def verify_admin(self, secret):
+        return True
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_lean_server_answers_profiles_longer_than_the_open_timeout(monkeypatch):
+    monkeypatch.setattr(network_relay, "CREDENTIAL_STORE", AllowAllCredentialStore())
+    port = free_port()
+
+    async def get(path):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                break
+            except OSError:
+                await asyncio.sleep(0.01)
+        writer.write(
+            f"GET {path} HTTP/1.1\r\n".encode()
+            + b"Host: relay\r\nAuthorization: Bearer admin\r\n\r\n"
+        )
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def scenario():
+        shutdown_event = asyncio.Event()
+        server = asyncio.create_task(
+            lean_server.serve_routes(
+                {},
+                "127.0.0.1",
+                port,
+                http_routes={"/admin/profile": network_relay.get_admin_profile},
+                shutdown_event=shutdown_event,
+            )
+        )
+        # longer than the 10 seconds websockets allows for a handshake
+        responses = [await get("/admin/profile?kind=stages&duration=11")]
+        while responses[-1].startswith(b"HTTP/1.1 503"):
+            assert b"Retry-After: 1" in responses[-1]
+            responses.append(await get("/admin/profile?kind=stages&duration=11"))
+        shutdown_event.set()
+        await server
+        return responses
+
+    with asyncio.Runner(loop_factory=FastClockEventLoop) as runner:
+        *retried, response = runner.run(scenario())
+    assert retried
+    head, _, body = response.partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 200 OK")
+    assert json.loads(body) == {}
@@ -0,0 +1,561 @@
+import asyncio
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+from http_network_relay import network_relay
+from http_network_relay.pydantic_models import (
+    AccessClientToRelayMessage,
+    AtRFanoutMessage,
+    AtRStartMessage,
+    AtRTCPDataMessage,
+    EdgeAgentToRelayMessage,
+    EtRInitiateConnectionOKMessage,
+    EtRPongMessage,
+    EtRStartMessage,
+    EtRTCPDataMessage,
+    RelayToAccessClientMessage,
+    RelayToEdgeAgentMessage,
+    RtAErrorMessage,
+    RtAFanoutDataMessage,
+    RtAFanoutDoneMessage,
+    RtAFanoutResultMessage,
+    RtAFanoutStartMessage,
+    RtARedirectMessage,
+    RtAStartOKMessage,
+    RtATCPDataMessage,
+    RtEConnectionResetMessage,
+    RtEInitiateConnectionMessage,
+    RtEMigrateMessage,
+    RtEPingMessage,
+    RtETCPDataMessage,
+)
+from http_network_relay.wire_format import CONNECTION_CLOSED_BY_TARGET
+
+
+class FakeWebSocket:
+    def __init__(self, received=()):
+        self.received = list(received)
+        self.sent = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self):
+        if not self.received:
+            raise WebSocketDisconnect()
+        return self.received.pop(0)
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        self.closed = True
+
+
+class AllowAllCredentialStore:
+    def verify_access_client(self, secret):
+        return True
+
+    def verify_edge_agent(self, name, secret):
+        return True
+
+
+def register_link(name, streams=(), srtt=None):
+    link = network_relay.AgentLink(name, FakeWebSocket(), network_relay.next_link_id)
+    network_relay.next_link_id += 1
+    link.streams.update(streams)
+    link.srtt = srtt
+    network_relay.registered_agent_connections.setdefault(name, []).append(link)
+    return link
+
+
+@pytest.fixture(autouse=True)
+def clean_relay_state():
+    yield
+    network_relay.registered_agent_connections.clear()
+    network_relay.active_connections.clear()
+    network_relay.pending_initiations.clear()
+    network_relay.access_client_connections.clear()
+    network_relay.draining = False
+    network_relay.drain_redirect_url = None
+    network_relay.drain_migration_until = 0
+    network_relay.shutdown_event.clear()
+
+
+def test_select_link_prefers_fewer_streams_then_lower_rtt():
+    busy = register_link("agent", streams={"a"}, srtt=0.01)
+    slow = register_link("agent", srtt=0.2)
+    fast = register_link("agent", srtt=0.05)
+    assert network_relay.select_link("agent") is fast
+    assert network_relay.select_link("agent", exclude=[fast]) is slow
+    assert network_relay.select_link("agent", exclude=[fast, slow]) is busy
+    assert network_relay.select_link("other") is None
+
+
+def test_record_pong_smooths_rtt(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(network_relay.time, "monotonic", lambda: clock[0])
+    link = register_link("agent")
+    assert link.state == "connecting"
+
+    ping = link.make_ping()
+    clock[0] = 100.1
+    link.record_pong(EtRPongMessage(ping_id=ping.ping_id, sent_at=ping.sent_at))
+    assert link.rtt == pytest.approx(0.1)
+    assert link.srtt == pytest.approx(0.1)
+    assert link.rttvar == pytest.approx(0.05)
+    assert link.state == "healthy"
+
+    clock[0] = 101.0
+    ping = link.make_ping()
+    clock[0] = 101.3
+    link.record_pong(EtRPongMessage(ping_id=ping.ping_id, sent_at=ping.sent_at))
+    assert link.rtt == pytest.approx(0.3)
+    assert link.srtt == pytest.approx(0.875 * 0.1 + 0.125 * 0.3)
+    assert link.rttvar == pytest.approx(0.75 * 0.05 + 0.25 * 0.2)
+
+    # a late answer to an older ping leaves the newest one outstanding
+    older = link.make_ping()
+    link.make_ping()
+    clock[0] += 0.05
+    link.record_pong(EtRPongMessage(ping_id=older.ping_id, sent_at=older.sent_at))
+    assert link.awaiting_pong_since is not None
+    clock[0] += network_relay.HEARTBEAT_INTERVAL + 1
+    assert link.state == "unresponsive"
+
+
+def test_heartbeat_evicts_silent_link(monkeypatch):
+    monkeypatch.setattr(network_relay, "HEARTBEAT_INTERVAL", 0.01)
+    monkeypatch.setattr(network_relay, "HEARTBEAT_TIMEOUT", 0.05)
+
+    async def scenario():
+        silent = register_link("agent", streams={"connection"})
+        answering = register_link("agent")
+        access_client = FakeWebSocket()
+        network_relay.active_connections["connection"] = (
+            silent.websocket,
+            access_client,
+        )
+
+        async def answer_pings():
+            while True:
+                await asyncio.sleep(0.005)
+                for data in answering.websocket.sent:
+                    ping = RelayToEdgeAgentMessage.model_validate_json(data).inner
+                    answering.record_pong(
+                        EtRPongMessage(ping_id=ping.ping_id, sent_at=ping.sent_at)
+                    )
+                answering.websocket.sent.clear()
+
+        answer_task = asyncio.create_task(answer_pings())
+        answering.heartbeat_task = asyncio.create_task(
+            network_relay.heartbeat(answering)
+        )
+        silent.heartbeat_task = asyncio.create_task(network_relay.heartbeat(silent))
+        await asyncio.wait_for(silent.heartbeat_task, timeout=1)
+        answer_task.cancel()
+        answering.heartbeat_task.cancel()
+
+        pings = [
+            RelayToEdgeAgentMessage.model_validate_json(data).inner
+            for data in silent.websocket.sent
+        ]
+        assert pings and all(isinstance(ping, RtEPingMessage) for ping in pings)
+        assert silent.websocket.closed
+        assert network_relay.registered_agent_connections == {"agent": [answering]}
+        assert answering.state == "healthy"
+        assert not silent.streams
+        assert "connection" not in network_relay.active_connections
+        [reset] = access_client.sent
+        assert RelayToAccessClientMessage.model_validate_json(
+            reset
+        ).inner == RtAErrorMessage(message="Edge agent stopped responding")
+        assert access_client.closed
+
+    asyncio.run(scenario())
+
+
+class FailingWebSocket(FakeWebSocket):
+    async def send_text(self, data):
+        raise RuntimeError("connection lost")
+
+
+def test_dead_links_are_unregistered(monkeypatch):
+    monkeypatch.setattr(network_relay, "CREDENTIAL_STORE", AllowAllCredentialStore())
+    monkeypatch.setattr(network_relay, "HEARTBEAT_INTERVAL", 0.01)
+
+    async def scenario():
+        # the route fails while forwarding to a broken access client
+        network_relay.active_connections["connection"] = (None, FailingWebSocket())
+        websocket = FakeWebSocket(
+            [
+                EdgeAgentToRelayMessage(
+                    inner=EtRStartMessage(name="agent", secret="secret")
+                ).model_dump_json(),
+                EdgeAgentToRelayMessage(
+                    inner=EtRTCPDataMessage(
+                        connection_id="connection", data_base64="U1NILTIuMA=="
+                    )
+                ).model_dump_json(),
+            ]
+        )
+        with pytest.raises(RuntimeError):
+            await network_relay.ws_for_edge_agents(websocket)
+        assert network_relay.registered_agent_connections == {}
+
+        # the agent's link breaks without the route noticing
+        link = network_relay.AgentLink("agent", FailingWebSocket(), 0)
+        network_relay.registered_agent_connections["agent"] = [link]
+        await asyncio.wait_for(network_relay.heartbeat(link), timeout=1)
+        assert network_relay.registered_agent_connections == {}
+        assert link.websocket.closed
+
+    asyncio.run(scenario())
+
+
+def test_initiation_fails_over_when_link_is_lost():
+    async def scenario():
+        first = register_link("agent", srtt=0.01)
+        second = register_link("agent", srtt=0.02)
+        initiation = asyncio.create_task(
+            network_relay.initiate_connection(
+                access_client_connection=FakeWebSocket(),
+                connection_target="agent",
+                target_ip="127.0.0.1",
+                target_port=22,
+                protocol="tcp",
+                connection_id="connection",
+            )
+        )
+        await asyncio.sleep(0)
+        assert len(first.websocket.sent) == 1
+        await network_relay.unregister_link(first, "Edge agent disconnected")
+        await asyncio.sleep(0)
+        assert len(second.websocket.sent) == 1
+        RelayToEdgeAgentMessage.model_validate_json(second.websocket.sent[0])
+
+        _link, answer = network_relay.pending_initiations["connection"]
+        answer.set_result(EtRInitiateConnectionOKMessage(connection_id="connection"))
+        assert await initiation is second
+        assert second.streams == {"connection"}
+        assert network_relay.active_connections["connection"][0] is second.websocket
+
+    asyncio.run(scenario())
+
+
+def test_agent_data_is_held_until_start_ok_was_sent():
+    async def scenario():
+        link = register_link("agent")
+        access_client = FakeWebSocket()
+        connection = asyncio.create_task(
+            network_relay.start_connection(
+                access_client, "agent", "127.0.0.1", 22, "tcp"
+            )
+        )
+        while not network_relay.pending_initiations:
+            await asyncio.sleep(0)
+        [(connection_id, (_link, answer))] = network_relay.pending_initiations.items()
+        # the agent's banner arrives with its OK answer, like in
+        # `ws_for_edge_agents`, before `start_connection` runs again
+        answer.set_result(EtRInitiateConnectionOKMessage(connection_id=connection_id))
+        _agent_connection, stream = network_relay.active_connections[connection_id]
+        await stream.send_text(
+            RelayToAccessClientMessage(
+                inner=RtATCPDataMessage(data_base64="U1NILTIuMA==")
+            ).model_dump_json()
+        )
+        await connection
+
+        messages = [
+            RelayToAccessClientMessage.model_validate_json(message).inner
+            for message in access_client.sent
+        ]
+        assert messages == [
+            RtAStartOKMessage(),
+            RtATCPDataMessage(data_base64="U1NILTIuMA=="),
+        ]
+
+    asyncio.run(scenario())
+
+
+def test_stream_closed_before_start_ok_is_not_served():
+    async def scenario():
+        register_link("agent")
+        data = AccessClientToRelayMessage(
+            inner=AtRTCPDataMessage(data_base64="aGVsbG8=")
+        ).model_dump_json()
+        access_client = FakeWebSocket([data])
+        connection = asyncio.create_task(
+            network_relay.start_connection(
+                access_client, "agent", "127.0.0.1", 22, "tcp"
+            )
+        )
+        while not network_relay.pending_initiations:
+            await asyncio.sleep(0)
+        [(connection_id, (_link, answer))] = network_relay.pending_initiations.items()
+        answer.set_result(EtRInitiateConnectionOKMessage(connection_id=connection_id))
+        # the target closes right away, like in `ws_for_edge_agents`
+        _agent_connection, stream = network_relay.active_connections.pop(connection_id)
+        await stream.close()
+        await connection
+
+        assert access_client.closed
+        assert access_client.received == [data]
+
+    asyncio.run(scenario())
+
+
+def test_drain_migrates_agents_and_shuts_down():
+    async def scenario():
+        links = [register_link("agent"), register_link("other")]
+        await network_relay.drain("ws://relay-2:8000/", spread=0, timeout=0)
+        for link in links:
+            migrate = RelayToEdgeAgentMessage.model_validate_json(
+                link.websocket.sent[0]
+            ).inner
+            assert migrate == RtEMigrateMessage(
+                relay_url="ws://relay-2:8000/ws_for_edge_agents", spread=0
+            )
+            assert link.websocket.closed
+        assert network_relay.registered_agent_connections == {}
+        assert network_relay.shutdown_event.is_set()
+
+    asyncio.run(scenario())
+
+
+class FailingPayloadWebSocket(FakeWebSocket):
+    async def send_text(self, data):
+        if '"tcp_data"' in data:
+            raise RuntimeError("link lost")
+        await super().send_text(data)
+
+
+def test_fanout_reports_failed_agent_link_and_finishes():
+    async def scenario():
+        healthy = register_link("sensor-1")
+        failing = network_relay.AgentLink(
+            "sensor-2", FailingPayloadWebSocket(), network_relay.next_link_id
+        )
+        network_relay.next_link_id += 1
+        network_relay.registered_agent_connections["sensor-2"] = [failing]
+        websocket = FakeWebSocket()
+        fanout = asyncio.create_task(
+            network_relay.fanout(
+                websocket,
+                AtRFanoutMessage(
+                    selector="sensor-*",
+                    target_ip="127.0.0.1",
+                    target_port=9100,
+                    protocol="tcp",
+                    secret="secret",
+                    data_base64="cHJvYmUK",
+                ),
+            )
+        )
+        while len(network_relay.pending_initiations) < 2:
+            await asyncio.sleep(0)
+        connection_ids = {}
+        for connection_id, (link, answer) in network_relay.pending_initiations.items():
+            connection_ids[link.name] = connection_id
+            answer.set_result(EtRInitiateConnectionOKMessage(connection_id=connection_id))
+        while connection_ids["sensor-2"] in network_relay.active_connections:
+            await asyncio.sleep(0)
+
+        _agent_connection, stream = network_relay.active_connections[
+            connection_ids["sensor-1"]
+        ]
+        await stream.send_text(
+            RelayToAccessClientMessage(
+                inner=RtAErrorMessage(message=CONNECTION_CLOSED_BY_TARGET)
+            ).model_dump_json()
+        )
+        await stream.close()
+        await fanout
+
+        messages = [
+            RelayToAccessClientMessage.model_validate_json(message).inner
+            for message in websocket.sent
+        ]
+        results = {
+            message.agent: message
+            for message in messages
+            if isinstance(message, RtAFanoutResultMessage)
+        }
+        assert results["sensor-1"].status == "ok"
+        assert results["sensor-2"].status == "error"
+        assert "link lost" in results["sensor-2"].message
+        assert messages[-1] == RtAFanoutDoneMessage(ok=1, failed=1)
+        assert healthy.streams == failing.streams == set()
+
+    asyncio.run(scenario())
+
+
+def test_draining_relay_redirects_access_clients(monkeypatch):
+    monkeypatch.setattr(network_relay, "CREDENTIAL_STORE", AllowAllCredentialStore())
+    started = []
+
+    async def start_connection(access_client_connection, connection_target, **kwargs):
+        started.append(connection_target)
+
+    monkeypatch.setattr(network_relay, "start_connection", start_connection)
+    network_relay.draining = True
+    network_relay.drain_redirect_url = "ws://relay-2:8000"
+    register_link("agent")
+
+    def connect(connection_target):
+        websocket = FakeWebSocket(
+            [
+                AccessClientToRelayMessage(
+                    inner=AtRStartMessage(
+                        connection_target=connection_target,
+                        target_ip="127.0.0.1",
+                        target_port=22,
+                        protocol="tcp",
+                        secret="secret",
+                    )
+                ).model_dump_json()
+            ]
+        )
+        asyncio.run(network_relay.ws_for_access_clients(websocket))
+        return websocket
+
+    def assert_redirected(websocket):
+        [response] = websocket.sent
+        assert RelayToAccessClientMessage.model_validate_json(
+            response
+        ).inner == RtARedirectMessage(
+            relay_url="ws://relay-2:8000/ws_for_access_clients"
+        )
+        assert websocket.closed
+
+    # while the agents migrate, the ones still linked here are served here
+    network_relay.drain_migration_until = network_relay.time.monotonic() + 30
+    assert connect("agent").sent == []
+    assert started == ["agent"]
+    assert_redirected(connect("migrated-agent"))
+
+    network_relay.drain_migration_until = network_relay.time.monotonic()
+    assert_redirected(connect("agent"))
+    assert started == ["agent"]
+
+
+class GoneAccessClientWebSocket(FakeWebSocket):
+    async def send_text(self, data):
+        if '"fanout_result"' in data:
+            raise RuntimeError("access client gone")
+        await super().send_text(data)
+
+
+def test_fanout_closes_the_websocket_unless_aborted(monkeypatch):
+    monkeypatch.setattr(network_relay, "CREDENTIAL_STORE", AllowAllCredentialStore())
+    register_link("sensor-1")
+
+    def run_fanout(websocket, selector):
+        websocket.received.append(
+            AccessClientToRelayMessage(
+                inner=AtRFanoutMessage(
+                    selector=selector,
+                    target_ip="127.0.0.1",
+                    target_port=9100,
+                    protocol="tcp",
+                    secret="secret",
+                    timeout=0.01,
+                )
+            ).model_dump_json()
+        )
+        asyncio.run(network_relay.ws_for_access_clients(websocket))
+        return websocket
+
+    websocket = run_fanout(FakeWebSocket(), "gw-*")
+    assert RelayToAccessClientMessage.model_validate_json(
+        websocket.sent[-1]
+    ).inner == RtAFanoutDoneMessage(ok=0, failed=0)
+    assert websocket.closed
+
+    websocket = run_fanout(GoneAccessClientWebSocket(), "sensor-*")
+    assert RelayToAccessClientMessage.model_validate_json(
+        websocket.sent[-1]
+    ).inner == RtAFanoutStartMessage(agents=["sensor-1"])
+    assert not websocket.closed
+
+
+def test_fanout_labels_answers_and_times_out():
+    async def scenario():
+        links = {name: register_link(name) for name in ["gw-1", "sensor-1", "sensor-2"]}
+        websocket = FakeWebSocket()
+        fanout = asyncio.create_task(
+            network_relay.fanout(
+                websocket,
+                AtRFanoutMessage(
+                    selector="sensor-*",
+                    target_ip="127.0.0.1",
+                    target_port=9100,
+                    protocol="tcp",
+                    secret="secret",
+                    data_base64="cHJvYmUK",
+                    timeout=0.2,
+                ),
+            )
+        )
+        while len(network_relay.pending_initiations) < 2:
+            await asyncio.sleep(0)
+        connection_ids = {}
+        for connection_id, (link, answer) in network_relay.pending_initiations.items():
+            connection_ids[link.name] = connection_id
+            answer.set_result(EtRInitiateConnectionOKMessage(connection_id=connection_id))
+        await asyncio.sleep(0)
+
+        # sensor-1 answers and closes the connection, sensor-2 does not
+        _agent_connection, stream = network_relay.active_connections[
+            connection_ids["sensor-1"]
+        ]
+        await stream.send_text(
+            RelayToAccessClientMessage(
+                inner=RtATCPDataMessage(data_base64="dXAgMQo=")
+            ).model_dump_json()
+        )
+        await stream.send_text(
+            RelayToAccessClientMessage(
+                inner=RtAErrorMessage(message=CONNECTION_CLOSED_BY_TARGET)
+            ).model_dump_json()
+        )
+        await stream.close()
+        await fanout
+
+        messages = [
+            RelayToAccessClientMessage.model_validate_json(message).inner
+            for message in websocket.sent
+        ]
+        assert messages[0] == RtAFanoutStartMessage(agents=["sensor-1", "sensor-2"])
+        assert messages[1] == RtAFanoutDataMessage(
+            agent="sensor-1", data_base64="dXAgMQo="
+        )
+        results = {
+            message.agent: message
+            for message in messages
+            if isinstance(message, RtAFanoutResultMessage)
+        }
+        assert results["sensor-1"].status == "ok"
+        assert results["sensor-1"].received == 5
+        assert results["sensor-2"].status == "timeout"
+        assert messages[-1] == RtAFanoutDoneMessage(ok=1, failed=1)
+
+        assert links["gw-1"].websocket.sent == []
+        sensor_2_messages = [
+            RelayToEdgeAgentMessage.model_validate_json(message).inner
+            for message in links["sensor-2"].websocket.sent
+        ]
+        assert isinstance(sensor_2_messages[0], RtEInitiateConnectionMessage)
+        assert sensor_2_messages[0].close_on_eof
+        assert sensor_2_messages[1] == RtETCPDataMessage(
+            connection_id=connection_ids["sensor-2"], data_base64="cHJvYmUK"
+        )
+        assert sensor_2_messages[2] == RtEConnectionResetMessage(
+            message="Fan-out timeout", connection_id=connection_ids["sensor-2"]
+        )
+        assert network_relay.active_connections == {}
+        assert all(not link.streams for link in links.values())
+
+    asyncio.run(scenario())
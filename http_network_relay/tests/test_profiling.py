@@ -0,0 +1,42 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from http_network_relay import profiling
+
+
+def test_stage_timers_only_measure_while_enabled():
+    timers = profiling.StageTimers()
+    with timers.measure("stage"):
+        pass
+    assert timers.report() == {}
+    timers.enabled = True
+    for _ in range(3):
+        with timers.measure("stage"):
+            pass
+    assert timers.report()["stage"]["count"] == 3
+
+
+def test_profile_kinds_and_limits():
+    async def scenario():
+        filename, content = await profiling.profile("cpu", 0.05)
+        assert filename == "profile.folded"
+        assert b"run_until_complete" in content
+
+        lag_profile = asyncio.create_task(profiling.profile("loop-lag", 0.1))
+        await asyncio.sleep(0.02)
+        with pytest.raises(profiling.ProfilingBusyError):
+            await profiling.profile("loop-lag", 0.1)
+        # block the event loop
+        time.sleep(0.05)
+        _filename, content = await lag_profile
+        assert json.loads(content)["max_lag_ms"] >= 40
+
+        with pytest.raises(ValueError):
+            await profiling.profile("loop-lag", profiling.MAX_PROFILE_DURATION + 1)
+        with pytest.raises(ValueError):
+            await profiling.profile("unknown", 1)
+
+    asyncio.run(scenario())
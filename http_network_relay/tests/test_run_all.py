@@ -7,10 +7,12 @@ import socket
 import random
 import tempfile
 import json
+import urllib.request
 import pytest
 
 @pytest.mark.timeout(10)
-def test_can_run_and_proxy_tcp():
+@pytest.mark.parametrize("server", ["fastapi", "lean"])
+def test_can_run_and_proxy_tcp(server):
     # start 3 threads to supervise 3 processes each, 1 more to listen to tcp
     # 0. start tcp listening thread
     # 1. start the relay server
@@ -70,6 +72,10 @@ def test_can_run_and_proxy_tcp():
                     str(port_relay),
                     "--credentials-file",
                     f.name,
+                    "--server",
+                    server,
+                    "--heartbeat-interval",
+                    "0.1",
                 ],
                 # env=env,
             )
@@ -88,11 +94,30 @@ def test_can_run_and_proxy_tcp():
                 f"ws://127.0.0.1:{port_relay}/ws_for_edge_agents",
                 "--name",
                 agent_name,
+                "--links",
+                "2",
             ]
         )
         started_subprocesses.append(edge_agent)
         edge_agent.wait()
 
+    def fetch_agents():
+        agents_request = urllib.request.Request(
+            f"http://127.0.0.1:{port_relay}/agents",
+            headers={"Authorization": f"Bearer {relay_secret}"},
+        )
+        with urllib.request.urlopen(agents_request) as agents_response:
+            return json.load(agents_response)["agents"]
+
+    def wait_for_agents(condition):
+        while True:
+            try:
+                if condition(fetch_agents()):
+                    return
+            except OSError:
+                pass
+            time.sleep(0.05)
+
     tcp_thread = threading.Thread(target=tcp_listening_thread)
     relay_thread = threading.Thread(target=relay_server_thread)
     edge_agent_thread = threading.Thread(target=edge_agent_thread)
@@ -100,9 +125,9 @@ def test_can_run_and_proxy_tcp():
     tcp_thread.start()
     time.sleep(0.2)
     relay_thread.start()
-    time.sleep(0.5)
+    wait_for_agents(lambda agents: True)
     edge_agent_thread.start()
-    time.sleep(0.2)
+    wait_for_agents(lambda agents: len(agents) == 1 and len(agents[0]["links"]) == 2)
 
     access_client = subprocess.Popen(
         [
@@ -125,6 +150,9 @@ def test_can_run_and_proxy_tcp():
     access_client.stdin.write(b"hello\n")
     access_client.stdin.flush()
     response = access_client.stdout.readline()
+
+    agents = fetch_agents()
+
     access_client.stdin.close()
     access_client.terminate()
     access_client.kill()
@@ -132,8 +160,10 @@ def test_can_run_and_proxy_tcp():
     # kill other threads
     for p in started_subprocesses:
         p.terminate()
-        time.sleep(1)
-        p.kill()
+        try:
+            p.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            p.kill()
 
     tcp_thread.join()
     relay_thread.join()
@@ -141,3 +171,7 @@ def test_can_run_and_proxy_tcp():
     access_client.wait()
     
     assert response == b"olleh\n"
+    assert [agent["name"] for agent in agents] == [agent_name]
+    assert agents[0]["streams"] == 1
+    assert sorted(link["streams"] for link in agents[0]["links"]) == [0, 1]
+    assert agents[0]["status"] in ("connecting", "healthy")
@@ -0,0 +1,112 @@
+import base64
+import subprocess
+import sys
+
+from http_network_relay.pydantic_models import (
+    AccessClientToRelayMessage,
+    AtRFanoutMessage,
+    AtRStartMessage,
+    AtRTCPDataMessage,
+    EdgeAgentToRelayMessage,
+    EtRTCPDataMessage,
+    RelayToAccessClientMessage,
+    RtAErrorMessage,
+    RtATCPDataMessage,
+)
+from http_network_relay.wire_format import (
+    decode_message,
+    edge_agent_tcp_data_message_prefix,
+    encode_access_client_fanout_message,
+    encode_access_client_start_message,
+    encode_access_client_tcp_data_message,
+    encode_edge_agent_tcp_data_message,
+)
+
+
+def test_encoders_match_models():
+    start_message = AccessClientToRelayMessage.model_validate_json(
+        encode_access_client_start_message(
+            connection_target="agent",
+            target_ip="127.0.0.1",
+            target_port=22,
+            protocol="tcp",
+            secret='"quoted" secret',
+        )
+    ).inner
+    assert start_message == AtRStartMessage(
+        connection_target="agent",
+        target_ip="127.0.0.1",
+        target_port=22,
+        protocol="tcp",
+        secret='"quoted" secret',
+    )
+
+    fanout_message = AccessClientToRelayMessage.model_validate_json(
+        encode_access_client_fanout_message(
+            selector="sensor-*",
+            target_ip="127.0.0.1",
+            target_port=9100,
+            protocol="tcp",
+            secret="secret",
+            data=b"GET /metrics HTTP/1.0\r\n\r\n",
+            parallelism=8,
+            timeout=2.5,
+        )
+    ).inner
+    assert fanout_message == AtRFanoutMessage(
+        selector="sensor-*",
+        target_ip="127.0.0.1",
+        target_port=9100,
+        protocol="tcp",
+        secret="secret",
+        data_base64=base64.b64encode(b"GET /metrics HTTP/1.0\r\n\r\n").decode(),
+        parallelism=8,
+        timeout=2.5,
+    )
+
+    data = bytes(range(256))
+    tcp_data_message = AccessClientToRelayMessage.model_validate_json(
+        encode_access_client_tcp_data_message(data)
+    ).inner
+    assert isinstance(tcp_data_message, AtRTCPDataMessage)
+    assert base64.b64decode(tcp_data_message.data_base64) == data
+
+    buffer = memoryview(bytearray(data))
+    edge_agent_tcp_data_message = EdgeAgentToRelayMessage.model_validate_json(
+        encode_edge_agent_tcp_data_message(
+            edge_agent_tcp_data_message_prefix('"quoted" id'), buffer[:100]
+        )
+    ).inner
+    assert edge_agent_tcp_data_message == EtRTCPDataMessage(
+        connection_id='"quoted" id',
+        data_base64=base64.b64encode(data[:100]).decode("ascii"),
+    )
+
+
+def test_decode_message_matches_models():
+    message = decode_message(
+        RelayToAccessClientMessage(
+            inner=RtATCPDataMessage(data_base64="aGVsbG8=")
+        ).model_dump_json()
+    )
+    assert message == {"kind": "tcp_data", "data_base64": "aGVsbG8="}
+    message = decode_message(
+        RelayToAccessClientMessage(
+            inner=RtAErrorMessage(message="Agent not registered")
+        ).model_dump_json()
+    )
+    assert message == {"kind": "error", "message": "Agent not registered"}
+
+
+def test_access_client_does_not_import_pydantic():
+    # `access-client` is started for every connection, see
+    # benchmarks/access_client_startup.py
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, http_network_relay.access_client; "
+            "assert 'pydantic' not in sys.modules, 'pydantic was imported'",
+        ],
+        check=True,
+    )
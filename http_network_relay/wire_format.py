@@ -0,0 +1,121 @@
+"""
+Hand-written encoders and decoders for messages on hot paths.
+
+They produce and accept the same JSON as the models in `pydantic_models`,
+which remain the definition of the protocol, but they do not need pydantic
+to be imported and do not build a model for every message. Keep both in
+sync, `tests/test_wire_format.py` checks the encoders against the models.
+"""
+
+import base64
+import binascii
+import json
+
+# `message` of the `connection_reset` message an edge agent sends when the
+# target closed the connection, the other reset reasons are errors
+CONNECTION_CLOSED_BY_TARGET = "Connection closed by target"
+
+TCP_DATA_MESSAGE_PREFIX = '{"inner":{"kind":"tcp_data","data_base64":"'
+TCP_DATA_MESSAGE_SUFFIX = '"}}'
+TCP_DATA_MESSAGE_SUFFIX_BYTES = TCP_DATA_MESSAGE_SUFFIX.encode("ascii")
+
+
+def encode_access_client_start_message(
+    connection_target: str,
+    target_ip: str,
+    target_port: int,
+    protocol: str,
+    secret: str,
+) -> str:
+    return json.dumps(
+        {
+            "inner": {
+                "kind": "start",
+                "connection_target": connection_target,
+                "target_ip": target_ip,
+                "target_port": target_port,
+                "protocol": protocol,
+                "secret": secret,
+            }
+        }
+    )
+
+
+def encode_access_client_fanout_message(
+    selector: str,
+    target_ip: str,
+    target_port: int,
+    protocol: str,
+    secret: str,
+    data: bytes,
+    parallelism: int,
+    timeout: float,
+) -> str:
+    return json.dumps(
+        {
+            "inner": {
+                "kind": "fanout",
+                "selector": selector,
+                "target_ip": target_ip,
+                "target_port": target_port,
+                "protocol": protocol,
+                "secret": secret,
+                "data_base64": base64.b64encode(data).decode("ascii"),
+                "parallelism": parallelism,
+                "timeout": timeout,
+            }
+        }
+    )
+
+
+def encode_access_client_tcp_data_message(data: bytes) -> str:
+    return (
+        TCP_DATA_MESSAGE_PREFIX
+        + base64.b64encode(data).decode("ascii")
+        + TCP_DATA_MESSAGE_SUFFIX
+    )
+
+
+def edge_agent_tcp_data_message_prefix(connection_id: str) -> bytes:
+    """
+    The start of every data message of one connection, built once per
+    connection for `encode_edge_agent_tcp_data_message`.
+    """
+    return (
+        '{"inner":{"kind":"tcp_data","connection_id":'
+        + json.dumps(connection_id)
+        + ',"data_base64":"'
+    ).encode("ascii")
+
+
+def encode_edge_agent_tcp_data_message(prefix: bytes, data) -> bytes:
+    """
+    Encode `data`, any bytes-like object such as a `memoryview` of a receive
+    buffer, without copying it first. The result is ASCII and can be sent as
+    a text frame as is.
+
+    Joining the parts copies the encoded data once more, `binascii` cannot
+    encode into a preallocated buffer. Sending the parts as fragments of
+    one message would avoid that, at the cost of three frames per chunk.
+    """
+    return b"".join(
+        (
+            prefix,
+            binascii.b2a_base64(data, newline=False),
+            TCP_DATA_MESSAGE_SUFFIX_BYTES,
+        )
+    )
+
+
+def decode_message(json_data) -> dict:
+    """
+    Decode any message, `str` or UTF-8 `bytes`, and return its `inner`
+    dict, callers dispatch on its `kind`. Raises `ValueError` for
+    malformed messages.
+    """
+    try:
+        inner = json.loads(json_data)["inner"]
+        inner["kind"]
+    except (TypeError, KeyError) as e:
+        raise ValueError(f"Malformed message: {json_data!r}") from e
+    return inner